@@ -0,0 +1,191 @@
+# Michael Chen, 2016
+
+# Libraries
+from transposition import decode_move, encode_move
+import argparse
+import numpy
+import os
+import struct
+
+# Start of every cache file, followed by the number of buckets
+MAGIC = "CHAIAC01"
+HEADER_SIZE = 16
+
+# A record is three 64-bit words: check, info and score. info holds the
+# packed move in its low 16 bits, then the depth and the flag. check is the
+# key xored with the other two words, so a record that is only partly
+# written when another process reads it doesn't match any key.
+RECORD_WORDS = 3
+RECORD_SIZE = 8*RECORD_WORDS
+
+# Records in a bucket, a key is only ever stored in the bucket its key picks
+BUCKET_SIZE = 4
+BUCKET_WORDS = RECORD_WORDS*BUCKET_SIZE
+
+# Reinterprets a float as the 64 bits it is stored as, and back
+def float_bits(value):
+    return struct.unpack("<Q", struct.pack("<d", value))[0]
+
+def bits_float(bits):
+    return struct.unpack("<d", struct.pack("<Q", bits))[0]
+
+# Packs the depth, flag and move of a result into the info word. The depth
+# is never 0, so an empty record is one whose info is 0.
+def pack_info(depth, flag, move_code):
+    return move_code | (min(depth, 255) << 16) | (flag << 24)
+
+def info_depth(info):
+    return (info >> 16) & 255
+
+# Writes an empty cache file of about size_mb megabytes. The records are
+# left as a hole in the file, so it only takes up disk space as it fills.
+def create_cache(path, size_mb=64):
+    buckets = max(1, int(size_mb*1024*1024) // (RECORD_SIZE*BUCKET_SIZE))
+    with open(path, "wb") as cache_file:
+        cache_file.write(MAGIC + struct.pack("<Q", buckets))
+        cache_file.truncate(HEADER_SIZE + buckets*BUCKET_SIZE*RECORD_SIZE)
+
+# Search results kept on disk across runs, keyed by the board's Zobrist hash
+# like the transposition table. The file is a fixed array of records mapped
+# into memory, so a lookup reads one bucket straight out of the page cache.
+# Any number of processes can map the same file, what one writes the others
+# see right away, and no locking is needed since a torn record fails its
+# check. Scores come from the evaluation that searched them, so a cache has
+# to be thrown away when the evaluation changes.
+class AnalysisCache:
+
+    # Maps the cache at path, creating it with room for about size_mb
+    # megabytes if it doesn't exist. A read only cache ignores stores.
+    def __init__(self, path, size_mb=64, read_only=False):
+        if not os.path.exists(path) and not read_only:
+            create_cache(path, size_mb)
+        with open(path, "rb") as cache_file:
+            header = cache_file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE or header[:8] != MAGIC:
+            raise ValueError(path + " is not an analysis cache")
+        self.path = path
+        self.read_only = read_only
+        self.buckets = struct.unpack("<Q", header[8:])[0]
+        self.words = numpy.memmap(path, dtype="<u8", mode="r" if read_only else "r+",
+                                  offset=HEADER_SIZE, shape=(self.buckets*BUCKET_WORDS,))
+        # Probes and probes that found their key since the cache was opened
+        self.probes = 0
+        self.hits = 0
+
+    # Writes what was stored out to the file and unmaps it
+    def close(self):
+        if not self.read_only:
+            self.words.flush()
+        self.words = None
+
+    # Words of the bucket the key belongs to, as plain integers
+    def bucket(self, key):
+        start = (key % self.buckets)*BUCKET_WORDS
+        return start, self.words[start:start + BUCKET_WORDS].tolist()
+
+    # Returns (depth, score, flag, move) for the key, or None on a miss
+    def probe(self, key):
+        self.probes += 1
+        start, words = self.bucket(key)
+        for index in range(0, BUCKET_WORDS, RECORD_WORDS):
+            check, info, bits = words[index:index + RECORD_WORDS]
+            if info and check ^ info ^ bits == key:
+                self.hits += 1
+                return (int(info_depth(info)), bits_float(bits), int(info >> 24), decode_move(info & 0xffff))
+        return None
+
+    # Stores a search result. The key's own record is only replaced by a
+    # result at least as deep, otherwise the shallowest record of the bucket
+    # gives way, as long as it isn't deeper than the new result.
+    def store(self, key, depth, score, flag, move):
+        if self.read_only:
+            return
+        start, words = self.bucket(key)
+        target = None
+        for index in range(0, BUCKET_WORDS, RECORD_WORDS):
+            check, info, bits = words[index:index + RECORD_WORDS]
+            if info and check ^ info ^ bits == key:
+                if info_depth(info) > depth:
+                    return
+                # Keep the old best move if this result didn't produce one
+                if move is None:
+                    move = decode_move(info & 0xffff)
+                target = index
+                break
+            if target is None or info_depth(info) < info_depth(words[target + 1]):
+                target = index
+        else:
+            if info_depth(words[target + 1]) > depth:
+                return
+        info = pack_info(depth, flag, encode_move(move))
+        bits = float_bits(score)
+        self.words[start + target:start + target + RECORD_WORDS] = [key ^ info ^ bits, info, bits]
+
+    # Yields (key, depth, score, flag, move) for every record in the cache.
+    # A record is only yielded if its key belongs in the bucket it is in,
+    # which also weeds out torn records.
+    def records(self):
+        for start in range(0, len(self.words), BUCKET_WORDS):
+            words = self.words[start:start + BUCKET_WORDS].tolist()
+            for index in range(0, BUCKET_WORDS, RECORD_WORDS):
+                check, info, bits = words[index:index + RECORD_WORDS]
+                key = check ^ info ^ bits
+                if info and (key % self.buckets)*BUCKET_WORDS == start:
+                    yield (key, int(info_depth(info)), bits_float(bits), int(info >> 24), decode_move(info & 0xffff))
+
+    # Number of records in use and how many there are at every depth
+    def usage(self):
+        infos = self.words[1::RECORD_WORDS]
+        depths = (infos[infos != 0] >> numpy.uint64(16)) & numpy.uint64(255)
+        histogram = numpy.bincount(depths.astype(numpy.int64)) if len(depths) else []
+        return {"records": len(infos), "used": len(depths),
+                "depths": dict((depth, int(count)) for depth, count in enumerate(histogram) if count)}
+
+# Writes every record at or above min_depth of the input caches into a new
+# cache at output_path of about size_mb megabytes, the deepest result
+# winning when a position is in several of them or when the new cache is
+# too small for all of them. Records are streamed from one file to the
+# other, so no cache is ever loaded whole. Compacting is merging a single
+# cache. Returns the number of records written.
+def merge_caches(input_paths, output_path, size_mb=64, min_depth=1):
+    create_cache(output_path, size_mb)
+    output = AnalysisCache(output_path)
+    for path in input_paths:
+        cache = AnalysisCache(path, read_only=True)
+        for key, depth, score, flag, move in cache.records():
+            if depth >= min_depth:
+                output.store(key, depth, score, flag, move)
+        cache.close()
+    written = output.usage()["used"]
+    output.close()
+    return written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "compacts, merges and inspects analysis cache files")
+    subparsers = parser.add_subparsers(dest="command")
+    merge_parser = subparsers.add_parser("merge",
+        help = "writes the records of one or more caches into a new cache, keeping the deepest")
+    merge_parser.add_argument("output_file",
+        help = "cache file to write, replaced if it exists")
+    merge_parser.add_argument("input_files", nargs="+",
+        help = "cache files to read; with just one this compacts it")
+    merge_parser.add_argument("--size_mb", type=float, default=64,
+        help = "size of the new cache in megabytes")
+    merge_parser.add_argument("--min_depth", type=int, default=1,
+        help = "records searched shallower than this are dropped")
+    stats_parser = subparsers.add_parser("stats",
+        help = "prints how full a cache is and the depths of its records")
+    stats_parser.add_argument("cache_file",
+        help = "cache file to inspect")
+    args = parser.parse_args()
+    if args.command == "merge":
+        if os.path.abspath(args.output_file) in [os.path.abspath(path) for path in args.input_files]:
+            parser.error("the output file can't be one of the inputs")
+        print "Records: " + str(merge_caches(args.input_files, args.output_file, args.size_mb, args.min_depth))
+    else:
+        cache = AnalysisCache(args.cache_file, read_only=True)
+        usage = cache.usage()
+        cache.close()
+        print "Records: " + str(usage["used"]) + " of " + str(usage["records"])
+        for depth in sorted(usage["depths"]):
+            print "Depth " + str(depth) + ": " + str(usage["depths"][depth])
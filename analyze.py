@@ -0,0 +1,171 @@
+# Michael Chen, 2016
+
+# Libraries
+from analysis_cache import AnalysisCache
+import argparse
+import chess
+import chess.pgn
+import chess_algos
+import collections
+import evaluation
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+# Search and evaluation owned by each worker process
+worker_search = None
+worker_evalfn = None
+
+# Yields (source, fen) for every position of an EPD file, source being the
+# position's id if it has one
+def read_epd(path):
+    with open(path) as epd:
+        for line_number, line in enumerate(epd):
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            source = "line " + str(line_number + 1)
+            if " id " in line:
+                source = line.split(" id ")[1].split(";")[0].strip().strip('"')
+            yield (source, " ".join(fields[:4] + ["0", "1"]))
+
+# Yields (source, fen) for every position of every game in a PGN file, one
+# game in memory at a time
+def read_pgn(path):
+    with open(path) as pgn:
+        game_number = 0
+        game = chess.pgn.read_game(pgn)
+        while game is not None:
+            game_number += 1
+            board = game.board()
+            node = game
+            yield ("game " + str(game_number) + " ply 0", board.fen())
+            while node.variations:
+                node = node.variations[0]
+                board.push(node.move)
+                yield ("game " + str(game_number) + " ply " + str(len(board.move_stack)), board.fen())
+            game = chess.pgn.read_game(pgn)
+
+# Reads the positions of a PGN or EPD file lazily
+def read_positions(path):
+    if path.lower().endswith(".pgn"):
+        return read_pgn(path)
+    return read_epd(path)
+
+# Sets up a worker with a search to the given depth, keeping what the
+# search prints out of the way. Every worker maps the same analysis cache,
+# if there is one, for nodes at least cache_depth deep.
+def init_worker(depth, hash_size, cache_path, cache_depth):
+    global worker_search, worker_evalfn
+    sys.stdout = open(os.devnull, "w")
+    if depth > 0:
+        worker_search = chess_algos.Negamax(depth, float("inf"), hash_size, analysis_cache=cache_path,
+                                            analysis_cache_depth=cache_depth)
+    # Same score as Evaluation("shannon"), computed from the bitboards
+    worker_evalfn = evaluation.Evaluation("bitboard")
+
+# Analyzes a chunk of (index, source, fen) positions in a worker. Tables are
+# cleared for every position so the results don't depend on which worker
+# got which chunk.
+def analyze_chunk(chunk):
+    records = []
+    for index, source, fen in chunk:
+        board = chess.Board(fen)
+        record = {"index": index, "source": source, "fen": fen, "eval": worker_evalfn.evaluate(board)}
+        if worker_search:
+            worker_search.tt.clear()
+            worker_search.ordering.clear()
+            move = worker_search.next_move(board)
+            iteration = worker_search.stats.iterations[-1]
+            record["move"] = move.uci() if move else None
+            record["score"] = iteration["score"]
+            record["pv"] = iteration["pv"]
+            record["nodes"] = iteration["nodes"] + iteration["qnodes"]
+        records.append(record)
+    return records
+
+# Number of complete records in the output, cutting off a line that was
+# only partly written when the last run was interrupted
+def completed_records(output_path):
+    if not os.path.exists(output_path):
+        return 0
+    records = 0
+    complete_length = 0
+    with open(output_path, "rb+") as output:
+        # Read in blocks so a big output isn't loaded all at once
+        for block in iter(lambda: output.read(1 << 20), ""):
+            if "\n" in block:
+                complete_length = output.tell() - len(block) + block.rfind("\n") + 1
+            records += block.count("\n")
+        output.truncate(complete_length)
+    return records
+
+# Writes a finished chunk and makes sure it reaches the disk
+def write_records(output, records):
+    for record in records:
+        output.write(json.dumps(record, sort_keys=True) + "\n")
+    output.flush()
+    os.fsync(output.fileno())
+    return len(records)
+
+# Analyzes every position of input_path and appends one JSON line per
+# position to output_path, in input order. Positions are read and handed to
+# the pool in chunks, with at most max_pending chunks in flight, so memory
+# stays bounded however big the input is. The output doubles as the
+# checkpoint: positions already in it are skipped. With cache_path, nodes
+# searched at least cache_depth deep go through the analysis cache there,
+# so positions analyzed by earlier runs come back cheaply. Returns the
+# number of positions analyzed by this run.
+def analyze(input_path, output_path, depth=3, workers=1, chunk_size=16, max_pending=None, hash_size=16,
+            cache_path=None, cache_size=64, cache_depth=3):
+    if max_pending is None:
+        max_pending = 2*workers
+    # Created here so the workers don't race to create it
+    if cache_path:
+        AnalysisCache(cache_path, cache_size).close()
+    skip = completed_records(output_path)
+    positions = itertools.islice(enumerate(read_positions(input_path)), skip, None)
+    chunks = iter(lambda: [(index, source, fen) for index, (source, fen)
+                           in itertools.islice(positions, chunk_size)], [])
+    pool = multiprocessing.Pool(workers, init_worker, (depth, hash_size, cache_path, cache_depth))
+    analyzed = 0
+    pending = collections.deque()
+    try:
+        with open(output_path, "a") as output:
+            for chunk in chunks:
+                pending.append(pool.apply_async(analyze_chunk, (chunk,)))
+                # Wait for the oldest chunk before reading more input
+                if len(pending) >= max_pending:
+                    analyzed += write_records(output, pending.popleft().get())
+            while pending:
+                analyzed += write_records(output, pending.popleft().get())
+    finally:
+        pool.terminate()
+    return analyzed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "scores every position of an EPD or PGN file")
+    parser.add_argument("input_file",
+        help = "EPD file, or PGN file whose games are analyzed position by position")
+    parser.add_argument("output_file",
+        help = "JSONL file results are appended to; an interrupted run picks up where it stopped")
+    parser.add_argument("--depth", type=int, default=3,
+        help = "depth negamax searches every position to, 0 only evaluates")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+        help = "number of processes analyzing positions")
+    parser.add_argument("--chunk_size", type=int, default=16,
+        help = "positions handed to a worker at a time")
+    parser.add_argument("--max_pending", type=int,
+        help = "most chunks in flight at once, twice the workers by default")
+    parser.add_argument("--cache",
+        help = "analysis cache file deep search results are kept in across runs, created if missing")
+    parser.add_argument("--cache_size", type=float, default=64,
+        help = "size in megabytes of a new analysis cache")
+    parser.add_argument("--cache_depth", type=int, default=3,
+        help = "least depth a node is searched to for it to go through the analysis cache")
+    args = parser.parse_args()
+    print "Positions: " + str(analyze(args.input_file, args.output_file, args.depth, args.workers,
+                                       args.chunk_size, args.max_pending, cache_path=args.cache,
+                                       cache_size=args.cache_size, cache_depth=args.cache_depth))
@@ -0,0 +1,195 @@
+# Michael Chen, 2016
+
+# Libraries
+from evaluation import Evaluation
+import argparse
+import chess
+import chess_algos
+import evaluation
+import gc
+import json
+import sys
+import time
+import weakref
+
+# Standard perft positions with the depth to run and the known leaf count
+perft_positions = [
+    (chess.STARTING_FEN, 3, 8902),
+    ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", 2, 2039),
+    ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", 3, 2812),
+    ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", 2, 264),
+    ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", 2, 1486)]
+
+# Positions the evaluations and searches are timed on: the Bratko-Kopec
+# test followed by a few opening and endgame positions
+bench_positions = [
+    "1k1r4/pp1b1R2/3q2pp/4p3/2B5/4Q3/PPP2B2/2K5 b - -",
+    "3r1k2/4npp1/1ppr3p/p6P/P2PPPP1/1NR5/5K2/2R5 w - -",
+    "2q1rr1k/3bbnnp/p2p1pp1/2pPp3/PpP1P1P1/1P2BNNP/2BQ1PRK/7R b - -",
+    "rnbqkb1r/p3pppp/1p6/2ppP3/3N4/2P5/PPP1QPPP/R1B1KB1R w KQkq -",
+    "r1b2rk1/2q1b1pp/p2ppn2/1p6/3QP3/1BN1B3/PPP3PP/R4RK1 w - -",
+    "2r3k1/pppR1pp1/4p3/4P1P1/5P2/1P4K1/P1P5/8 w - -",
+    "1nk1r1r1/pp2n1pp/4p3/q2pPp1N/b1pP1P2/B1P2R2/2P1B1PP/R2Q2K1 w - -",
+    "4b3/p3kp2/6p1/3pP2p/2pP1P2/4K1P1/P3N2P/8 w - -",
+    "2kr1bnr/pbpq4/2n1pp2/3p3p/3P1P1B/2N2N1Q/PPP3PP/2KR1B1R w - -",
+    "3rr1k1/pp3pp1/1qn2np1/8/3p4/PP1R1P2/2P1NQPP/R1B3K1 b - -",
+    "2r1nrk1/p2q1ppp/bp1p4/n1pPp3/P1P1P3/2PBB1N1/4QPPP/R4RK1 w - -",
+    "r3r1k1/ppqb1ppp/8/4p1NQ/8/2P5/PP3PPP/R3R1K1 b - -",
+    "r2q1rk1/4bppp/p2p4/2pP4/3pP3/3Q4/PP1B1PPP/R3R1K1 w - -",
+    "rnb2r1k/pp2p2p/2pp2p1/q2P1p2/8/1Pb2NP1/PB2PPBP/R2Q1RK1 w - -",
+    "2r3k1/1p2q1pp/2b1pr2/p1pp4/6Q1/1P1PP1R1/P1PN2PP/5RK1 w - -",
+    "r1bqkb1r/4npp1/p1p4p/1p1pP1B1/8/1B6/PPPN1PPP/R2Q1RK1 w kq -",
+    "r2q1rk1/1ppnbppp/p2p1nb1/3Pp3/2P1P1P1/2N2N1P/PPB1QP2/R1B2RK1 b - -",
+    "r1bq1rk1/pp2ppbp/2np2p1/2n5/P3PP2/N1P2N2/1PB3PP/R1B1QRK1 b - -",
+    "3rr3/2pq2pk/p2p1pnp/8/2QBPP2/1P6/P5PP/4RRK1 b - -",
+    "r4k2/pb2bp1r/1p1qp2p/3pNp2/3P1P2/2N3P1/PPP1Q2P/2KRR3 w - -",
+    "3rn2k/ppb2rpp/2ppqp2/5N2/2P1P3/1P5Q/PB3PPP/3RR1K1 w - -",
+    "2r2rk1/1bqnbpp1/1p1ppn1p/pP6/N1P1P3/P2B1N1P/1B2QPP1/R2R2K1 b - -",
+    "r1bqk2r/pp2bppp/2p5/3pP3/P2Q1P2/2N1B3/1PP3PP/R4RK1 b kq -",
+    "r2qnrnk/p2b2b1/1p1p2pp/2pPpp2/1PP1P3/PRNBB3/3QNPPP/5RK1 w - -",
+    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -",
+    "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq -",
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -",
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - -",
+    "6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - -",
+    "8/8/4k3/3p4/3P4/4K3/8/8 w - -"]
+
+# Object that only a garbage collection can free
+class Cycle:
+    pass
+
+# Counts garbage collections. Python 2 has no hook for them, so a reference
+# cycle is left lying around and counted when a collection frees it, and a
+# new one is put in its place.
+class CollectionCounter:
+
+    def __init__(self):
+        self.collections = 0
+        self.arm()
+
+    # Leaves a new cycle for the next collection to find
+    def arm(self):
+        cycle = Cycle()
+        cycle.cycle = cycle
+        self.sentinel = weakref.ref(cycle, self.collected)
+
+    # Called by the collection that freed the cycle
+    def collected(self, sentinel):
+        self.collections += 1
+        self.arm()
+
+collection_counter = CollectionCounter()
+
+# Number of leaves depth plies below the board
+def perft(board, depth):
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in board.legal_moves:
+        board.push(move)
+        nodes += perft(board, depth - 1)
+        board.pop()
+    return nodes
+
+# Times perft on the standard positions and checks the leaf counts
+def bench_perft():
+    results = []
+    total_nodes = 0
+    start_time = time.time()
+    for fen, depth, expected in perft_positions:
+        position_start = time.time()
+        nodes = perft(chess.Board(fen), depth)
+        total_nodes += nodes
+        results.append({"fen": fen, "depth": depth, "nodes": nodes, "correct": nodes == expected,
+                        "seconds": time.time() - position_start})
+    seconds = time.time() - start_time
+    return {"positions": results, "nodes": total_nodes, "seconds": seconds, "nps": total_nodes/seconds}
+
+# Times an evaluation function over the bench positions, repeated rounds times
+def bench_evaluation(evaluation_fn, rounds):
+    evaluate = Evaluation(evaluation_fn).evaluate
+    boards = [chess.Board(fen + " 0 1") for fen in bench_positions]
+    start_time = time.time()
+    for round_index in range(rounds):
+        for board in boards:
+            evaluate(board)
+    seconds = time.time() - start_time
+    evaluations = rounds*len(boards)
+    return {"evaluations": evaluations, "seconds": seconds, "per_second": evaluations/seconds}
+
+# Searches every bench position to a fixed depth with search, starting
+# from empty tables each time so the node counts don't depend on the order.
+# The signature is the total node count, it only changes when the search
+# itself does. With gc_off the collector is turned off while searching, the
+# time difference to a run with it on is what collections cost.
+def bench_search(search, gc_off=False):
+    results = []
+    total_nodes = 0
+    collections = collection_counter.collections
+    if gc_off:
+        gc.disable()
+    start_time = time.time()
+    for fen in bench_positions:
+        board = chess.Board(fen + " 0 1")
+        search.tt.clear()
+        search.ordering.clear()
+        if search.eval_cache:
+            search.eval_cache.clear()
+        position_start = time.time()
+        move = search.next_move(board)
+        nodes = search.nodes + search.qnodes
+        total_nodes += nodes
+        results.append({"fen": fen, "move": move.uci() if move else None, "nodes": nodes,
+                        "seconds": time.time() - position_start})
+    seconds = time.time() - start_time
+    gc.enable()
+    return {"depth": search.depth, "positions": results, "nodes": total_nodes, "seconds": seconds,
+            "nps": total_nodes/seconds, "signature": total_nodes,
+            "gc_collections": collection_counter.collections - collections}
+
+# Runs the whole bench and returns the results. With gc_cost the negamax
+# search is run a second time with the collector off.
+def run_bench(minimax_depth=2, negamax_depth=3, eval_rounds=20, gc_cost=False):
+    results = {"perft": bench_perft(),
+               "evaluation": {"naive": bench_evaluation("naive", eval_rounds),
+                              "shannon": bench_evaluation("shannon", eval_rounds),
+                              "bitboard": bench_evaluation("bitboard", eval_rounds)}}
+    results["minimax"] = bench_search(chess_algos.Minimax(minimax_depth, True))
+    results["negamax"] = bench_search(chess_algos.Negamax(negamax_depth, float("inf")))
+    results["signature"] = results["minimax"]["signature"] + results["negamax"]["signature"]
+    if gc_cost:
+        negamax_off = bench_search(chess_algos.Negamax(negamax_depth, float("inf")), True)
+        results["gc"] = {"collections": results["negamax"]["gc_collections"],
+                         "seconds_off": negamax_off["seconds"],
+                         "gc_seconds": results["negamax"]["seconds"] - negamax_off["seconds"]}
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "times move generation, evaluation and search")
+    parser.add_argument("--minimax_depth", type=int, default=2,
+        help = "depth minimax searches every bench position to")
+    parser.add_argument("--negamax_depth", type=int, default=3,
+        help = "depth negamax searches every bench position to")
+    parser.add_argument("--eval_rounds", type=int, default=20,
+        help = "number of times every position is evaluated")
+    parser.add_argument("--profile", action="store_true",
+        help = "record the time spent in each evaluation factor, which slows everything down")
+    parser.add_argument("--gc", action="store_true",
+        help = "search again with the garbage collector off to time what collections cost")
+    parser.add_argument("--output",
+        help = "file to write the JSON results to instead of stdout")
+    args = parser.parse_args()
+    # Keep what the searches print out of the JSON
+    output = sys.stdout
+    sys.stdout = sys.stderr
+    if args.profile:
+        evaluation.start_profiling()
+    results = run_bench(args.minimax_depth, args.negamax_depth, args.eval_rounds, args.gc)
+    if args.profile:
+        results["factors"] = evaluation.factor_profile()
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write("\n")
@@ -0,0 +1,91 @@
+# Michael Chen, 2016
+
+# Libraries
+import argparse
+import chess
+import chess.pgn
+import chess.polyglot
+import collections
+import random
+
+# Polyglot promotion codes, 0 means no promotion
+promotion_codes = {None: 0, chess.KNIGHT: 1, chess.BISHOP: 2, chess.ROOK: 3, chess.QUEEN: 4}
+
+# Weight a game adds to the moves of a side that won, drew or lost it
+result_weights = {"win": 2, "draw": 1, "loss": 0}
+
+# Opening book read from a Polyglot .bin file. The file is mapped into
+# memory and positions are found by binary search on its sorted keys, so
+# opening a book costs nothing no matter how big it is.
+class OpeningBook:
+
+    # Map the book at path into memory
+    def __init__(self, path):
+        self.reader = chess.polyglot.open_reader(path)
+
+    # Unmap the book
+    def close(self):
+        self.reader.close()
+
+    # Returns a book move for the board picked at random by weight, or None
+    # if the position is out of book
+    def next_move(self, board):
+        try:
+            entry = self.reader.weighted_choice(board, random=random)
+        except IndexError:
+            return None
+        return entry.move()
+
+# Packs a move the way Polyglot stores it. Castling is written as the king
+# moving onto its rook.
+def encode_move(board, move):
+    to_square = move.to_square
+    if board.is_castling(move) and board.piece_type_at(to_square) != chess.ROOK:
+        rank_index = chess.rank_index(move.from_square)
+        kingside = chess.file_index(to_square) > chess.file_index(move.from_square)
+        to_square = chess.square(7 if kingside else 0, rank_index)
+    return to_square | (move.from_square << 6) | (promotion_codes[move.promotion] << 12)
+
+# Builds a Polyglot book from the games of a PGN file, looking at the first
+# max_ply half moves of each game. A move is weighted by how well the side
+# that played it did. Returns the number of entries written.
+def build_book(pgn_path, book_path, max_ply=20):
+    weights = collections.defaultdict(int)
+    with open(pgn_path) as pgn:
+        game = chess.pgn.read_game(pgn)
+        while game is not None:
+            result = game.headers.get("Result", "*")
+            board = game.board()
+            node = game
+            while node.variations and len(board.move_stack) < max_ply:
+                node = node.variations[0]
+                move = node.move
+                # Unfinished games count as draws
+                if result == ("1-0" if board.turn else "0-1"):
+                    weight = result_weights["win"]
+                elif result == ("0-1" if board.turn else "1-0"):
+                    weight = result_weights["loss"]
+                else:
+                    weight = result_weights["draw"]
+                weights[(board.zobrist_hash(), encode_move(board, move))] += weight
+                board.push(move)
+            game = chess.pgn.read_game(pgn)
+
+    # Entries are sorted by key, the best moves of a position first
+    entries = sorted(((key, raw_move, min(weight, 0xffff)) for (key, raw_move), weight in weights.items()
+                      if weight > 0), key=lambda entry: (entry[0], -entry[2], entry[1]))
+    with open(book_path, "wb") as book:
+        for key, raw_move, weight in entries:
+            book.write(chess.polyglot.ENTRY_STRUCT.pack(key, raw_move, weight, 0))
+    return len(entries)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "builds a Polyglot opening book from a PGN file")
+    parser.add_argument("pgn_file",
+        help = "games to build the book from")
+    parser.add_argument("book_file",
+        help = "Polyglot .bin file to write")
+    parser.add_argument("--max_ply", type=int, default=20,
+        help = "number of half moves of each game that go into the book")
+    args = parser.parse_args()
+    print "Entries: " + str(build_book(args.pgn_file, args.book_file, args.max_ply))
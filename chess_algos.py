@@ -1,16 +1,132 @@
 # Michael Chen, 2016
 
 # Libraries
+from analysis_cache import AnalysisCache
 from random import randint
 import chess
 import evaluation
+import math
+import move_ordering
+import multiprocessing
 import numpy
+import random
+import search_stats
 import sys
 import time
+import transposition
+from transposition import EXACT, LOWER, UPPER
 
-# Intialize the two evaluation classes
+# Intialize the two evaluation classes, the bitboard version of the shannon
+# evaluation gives the same scores in a fraction of the time
 naive_evalfn = evaluation.Evaluation("naive")
-shannon_evalfn = evaluation.Evaluation("shannon")
+shannon_evalfn = evaluation.Evaluation("bitboard")
+
+# Raised inside a search once its hard deadline has passed or it was told
+# to stop
+class SearchAborted(Exception):
+    pass
+
+# Most plies a search keeps per-ply state for
+max_ply = 128
+
+# The move that passes the turn, made once and shared by every search
+null_move = chess.Move.null()
+
+# Per-ply state of a search, allocated once and reused by every node so the
+# nodes themselves don't build tuples or lists. pv is the triangular
+# principal variation table: row ply holds the best line found from that
+# ply on and pv_lengths[ply] how many moves of it are valid.
+class SearchStack(object):
+    __slots__ = ("pv", "pv_lengths")
+
+    def __init__(self, size=max_ply):
+        self.pv = [[None]*size for ply in range(size)]
+        self.pv_lengths = [0]*size
+
+    # Makes move followed by the line below it the line of ply
+    def update_pv(self, ply, move):
+        line = self.pv[ply]
+        child_line = self.pv[ply + 1]
+        length = self.pv_lengths[ply + 1]
+        line[0] = move
+        for index in xrange(length):
+            line[index + 1] = child_line[index]
+        self.pv_lengths[ply] = length + 1
+
+    # Makes move alone the line of ply, for results taken from the table
+    def set_pv(self, ply, move):
+        self.pv[ply][0] = move
+        self.pv_lengths[ply] = 1 if move is not None else 0
+
+    # The line found from ply on
+    def line(self, ply=0):
+        return self.pv[ply][:self.pv_lengths[ply]]
+
+# Same as board.is_game_over(), with the cheap tests first and without the
+# variant checks and the hash it computes at every node. Five repetitions
+# need at least 16 reversible plies in a row.
+def game_over(board):
+    return (board.halfmove_clock >= 150 or board.is_insufficient_material()
+            or not any(board.generate_legal_moves())
+            or (board.halfmove_clock >= 16 and board.is_fivefold_repetition()))
+
+# Margin on top of the captured piece's value before a capture is assumed
+# unable to raise alpha in quiescence search
+delta_margin = 200
+
+# Capture-only search from a leaf until the position is quiet, so the leaf
+# score doesn't miss a hanging piece just past the horizon. search is the
+# Minimax or Negamax running it and supplies the evaluator, counters and
+# depth cap. Scores are from the point of view of the side to move.
+def quiesce(search, board, alpha, beta, qdepth=0):
+    search.qnodes += 1
+    if ((search.nodes + search.qnodes) % search.check_interval == 0
+            and (time.time() > search.hard_deadline or search.stop_flag.value)):
+        raise SearchAborted()
+    in_check = board.is_check()
+    # Standing pat is only allowed when not in check, the side to move could
+    # still decline every capture. Outside the window a bound on the score
+    # is all that's needed.
+    stand_pat = search.evaluator.evaluate(board, alpha, beta)
+    if qdepth >= search.max_qdepth:
+        return stand_pat
+    if in_check:
+        moves = list(board.legal_moves)
+        if not moves:
+            return stand_pat
+        evaluation_best = -sys.maxint
+    else:
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        moves = move_ordering.tactical_moves(board)
+        evaluation_best = stand_pat
+    for move in moves:
+        if not in_check:
+            # Delta pruning, skip captures that can't raise alpha even if the
+            # captured piece comes for free
+            if board.is_capture(move):
+                gain = evaluation.piece_svalue_dict[move_ordering.captured_type(board, move)]
+            else:
+                gain = 0
+            if move.promotion:
+                gain += evaluation.piece_svalue_dict[move.promotion] - evaluation.piece_svalue_dict[chess.PAWN]
+            if stand_pat + gain + delta_margin <= alpha:
+                continue
+            # Skip captures that lose material once the exchange plays out
+            if board.is_capture(move) and move_ordering.see(board, move) < 0:
+                continue
+        search.evaluator.push(board, move)
+        board.push(move)
+        next_move_value = -quiesce(search, board, -beta, -alpha, qdepth+1)
+        board.pop()
+        search.evaluator.pop()
+        if next_move_value > evaluation_best:
+            evaluation_best = next_move_value
+        alpha = max(alpha, next_move_value)
+        if alpha >= beta:
+            break
+    return evaluation_best
 
 # Class that does random moves only
 class Random:
@@ -32,13 +148,58 @@ class Minimax:
     depth = 0
     """Enable or disable alphabeta pruning"""
     alphabeta = False
-    """Keeps a hash of board positions seen before"""
-    board_hash = {}
+    """Keeps search results for positions seen before"""
+    tt = None
+    """Keeps the scores of evaluated positions, None when turned off"""
+    eval_cache = None
+    """Side the table's scores were computed for"""
+    root_turn = None
+    """Running material and piece-square totals for the searched board"""
+    evaluator = None
+    """Killer moves and history used to order the moves"""
+    ordering = None
+    """Nodes and quiescence nodes searched for the last move"""
+    nodes = 0
+    qnodes = 0
+    """Counters and results of the last alpha-beta search"""
+    stats = None
+    """Principal variation table reused by every alpha-beta search"""
+    stack = None
+    """Deepest quiescence search below the leaves, 0 turns it off"""
+    max_qdepth = 8
+    """Minimax has no time limit, but quiescence search looks at these, and
+    the stop flag is looked at every check_interval nodes"""
+    check_interval = 256
+    hard_deadline = float("inf")
 
-    # Intialize class with depth and alphabeta flag
-    def __init__(self, depth=3, alphabeta=False):
+    # Intialize class with depth, alphabeta flag, hash size in megabytes and
+    # the quiescence search depth cap. eval_cache_size is the evaluation
+    # cache size in megabytes, 0 turns it off.
+    def __init__(self, depth=3, alphabeta=False, hash_size=16, max_qdepth=8, eval_cache_size=4):
         self.depth = depth
         self.alphabeta = alphabeta
+        self.tt = transposition.TranspositionTable(hash_size)
+        self.eval_cache = evaluation.EvaluationCache(eval_cache_size) if eval_cache_size else None
+        self.max_qdepth = max_qdepth
+        self.ordering = move_ordering.MoveOrdering()
+        self.stats = search_stats.SearchStats()
+        self.stack = SearchStack()
+        # Set to stop an alpha-beta search from another thread
+        self.stop_flag = multiprocessing.RawValue("b", 0)
+
+    # Makes a running alpha-beta search give up and return the best root
+    # move it has searched so far, see stopped_move(). The naive search
+    # can't be stopped. The flag stays set until the caller
+    # clears it before the next search.
+    def stop(self):
+        self.stop_flag.value = 1
+
+    # Forget everything learned in the previous game
+    def new_game(self):
+        self.tt.clear()
+        self.ordering.clear()
+        if self.eval_cache:
+            self.eval_cache.clear()
 
     # Top level function to compute next move
     def next_move(self, board):
@@ -46,8 +207,33 @@ class Minimax:
         start_time = time.time()
         # If alpha beta is set
         if self.alphabeta:
+            # Scores are relative to the maximizing player, so they can't
+            # be reused if this instance now plays the other side
+            if board.turn != self.root_turn:
+                self.tt.clear()
+                self.root_turn = board.turn
+            self.tt.new_search()
+            self.ordering.new_search()
+            if self.eval_cache:
+                self.eval_cache.new_search()
+            self.evaluator = evaluation.IncrementalEvaluation(board, self.eval_cache)
+            self.nodes = 0
+            self.qnodes = 0
+            self.stats.reset()
+            root_length = len(board.move_stack)
             # Start the minimax function with initial values
-            move = self.calculate_move_ab(board, 0, self.depth, -sys.maxint, sys.maxint)[1]
+            try:
+                value = self.calculate_move_ab(board, 0, self.depth, -sys.maxint, sys.maxint)
+            except SearchAborted:
+                # Take back the moves the search left on the board
+                while len(board.move_stack) > root_length:
+                    board.pop()
+                print "Move Time: " + str(time.time() - start_time)
+                return self.stopped_move(board)
+            move = self.stack.pv[0][0] if self.stack.pv_lengths[0] else None
+            self.stats.add_iteration(self.depth, value, self.stack.line(),
+                self.nodes, self.qnodes, self.tt, self.eval_cache, time.time() - start_time)
+            print "Nodes: " + str(self.nodes) + " QNodes: " + str(self.qnodes)
             print "Move Time: " + str(time.time() - start_time)
             return move
         else:
@@ -55,80 +241,139 @@ class Minimax:
             print "Move Time: " + str(time.time() - start_time)
             return move
 
+    # Move to play when the search was stopped: the best of the root moves
+    # searched to the end, else the table's move for the root, else the
+    # first legal move if nothing was searched yet
+    def stopped_move(self, board):
+        if self.stack.pv_lengths[0]:
+            return self.stack.pv[0][0]
+        entry = self.tt.probe(board.zobrist_hash())
+        if entry and entry[3] is not None and board.is_legal(entry[3]):
+            return entry[3]
+        return next(iter(board.legal_moves), None)
+
     # Function that calculates te actual next move's value
     def move_value(self, board, player, move, depth, alpha, beta):
-        # Create a new board an push the move onto it
-        new_board = board.copy()
-        new_board.push_uci(move.uci())
-
-        next_move_value = None
-        # First check if that board is in the hash
-        if new_board.fen() in self.board_hash:
-            next_move_value = self.board_hash[new_board.fen()]
+        # Make the move in place, it's taken back once the child is searched
+        self.evaluator.push(board, move)
+        board.push(move)
+
+        # Recurse, the transposition table is checked by the child
+        if player == 0:
+            # Get the next move value and move
+            next_move_value = self.calculate_move_ab(
+                board, player+1, depth-1,
+                alpha, beta)
         else:
-            # If not, recurse
-            if player == 0:
-                # Get the next move value and move
-                next_move_value = self.calculate_move_ab(
-                    new_board, player+1, depth-1,
-                    alpha, beta)[0]
-            else:
-                # Get the next move value and move
-                next_move_value = self.calculate_move_ab(
-                    new_board, player-1, depth-1,
-                    alpha, beta)[0]
-            self.board_hash[new_board.fen()] = next_move_value
+            # Get the next move value and move
+            next_move_value = self.calculate_move_ab(
+                board, player-1, depth-1,
+                alpha, beta)
+        board.pop()
+        self.evaluator.pop()
         # Return the calculated move
         return next_move_value
 
     # Function that actually returns the optimal next move
     def calculate_move_ab(self, board, player, depth, alpha, beta):
         """ Perform minimax step for Player player on Board board
-            and return the optimal move"""
+            and return the optimal move's value, the move itself starts
+            the line of this ply in the stack"""
+        self.nodes += 1
+        if self.nodes % self.check_interval == 0 and self.stop_flag.value:
+            raise SearchAborted()
+        ply = self.depth - depth
+        stack = self.stack
+        stack.pv_lengths[ply] = 0
         if depth == 0:
-            return (shannon_evalfn.evaluate(board), None)
+            return quiesce(self, board, alpha, beta)
+        # Look the position up in the transposition table. Leaf scores are
+        # relative to the side to move at the leaf, so only entries searched
+        # to the same depth parity are comparable.
+        key = board.zobrist_hash()
+        entry = self.tt.probe(key)
+        hash_move = entry[3] if entry else None
+        if entry and entry[0] >= depth and (entry[0] - depth) % 2 == 0:
+            entry_depth, entry_score, entry_flag, entry_move = entry
+            if entry_flag == EXACT:
+                stack.set_pv(ply, entry_move)
+                return entry_score
+            elif entry_flag == LOWER:
+                alpha = max(alpha, entry_score)
+            else:
+                beta = min(beta, entry_score)
+            if beta < alpha:
+                stack.set_pv(ply, entry_move)
+                return entry_score
         # If current player
         if player == 0:
             new_alpha = alpha
             new_beta = beta
 
-            evaluation_max = (-sys.maxint, None)
-            legal_moves = board.legal_moves
+            evaluation_max = -sys.maxint
+            best_move = None
+            # Moves come in stages, best candidates first
+            legal_moves = self.ordering.pick_moves(board, hash_move, ply)
             # Loop through and recurisvely find the best move,
             # using a certain evaluation function
-            for move in legal_moves:
-                next_move_value = self.move_value(board, player, move, 
+            for index, move in enumerate(legal_moves):
+                next_move_value = self.move_value(board, player, move,
                     depth, new_alpha, new_beta)
                 # Set the max as needed
-                if next_move_value > evaluation_max[0]:
-                    evaluation_max = (next_move_value, move)
+                if next_move_value > evaluation_max:
+                    evaluation_max = next_move_value
+                    best_move = move
+                    stack.update_pv(ply, move)
                 # Update alpha and check for pruning
-                new_alpha = max(new_alpha, evaluation_max[0])
+                if evaluation_max > new_alpha:
+                    new_alpha = evaluation_max
                 if new_beta < new_alpha:
+                    self.ordering.update(board, move, depth, ply)
+                    self.stats.cutoff(index)
                     break
+            self.store_result(key, depth, evaluation_max, best_move, alpha, beta)
             return evaluation_max
         # If opposing player
         else:
             new_alpha = alpha
             new_beta = beta
 
-            evaluation_min = (sys.maxint, None)
-            legal_moves = board.legal_moves
+            evaluation_min = sys.maxint
+            best_move = None
+            # Moves come in stages, best candidates first
+            legal_moves = self.ordering.pick_moves(board, hash_move, ply)
             # Loop through and recurisvely find the best move,
             # using a certain evaluation function
-            for move in legal_moves:
+            for index, move in enumerate(legal_moves):
                 next_move_value = self.move_value(board, player, move,
                     depth, new_alpha, new_beta)
 
                 # Set the min as needed
-                if next_move_value < evaluation_min[0]:
-                    evaluation_min = (next_move_value, move)
+                if next_move_value < evaluation_min:
+                    evaluation_min = next_move_value
+                    best_move = move
+                    stack.update_pv(ply, move)
                 # Update beta and check for purning
-                new_beta = min(new_beta, evaluation_min[0])
+                if evaluation_min < new_beta:
+                    new_beta = evaluation_min
                 if new_beta < new_alpha:
+                    self.ordering.update(board, move, depth, ply)
+                    self.stats.cutoff(index)
                     break
+            self.store_result(key, depth, evaluation_min, best_move, alpha, beta)
             return evaluation_min
 
+    # Saves a node's result with the bound it represents for the window it
+    # was searched with
+    def store_result(self, key, depth, value, move, alpha, beta):
+        if value <= alpha:
+            flag = UPPER
+        elif value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.tt.store(key, depth, value, flag, move)
+
     # Same as previous funciton, but uses the naive evaluation function instead
     def calculate_move_naive(self, board, player, depth):
         """ Perform minimax step for Player player on Board board
@@ -137,32 +382,36 @@ class Minimax:
             return (naive_evalfn.evaluate(board), None)
         if player == 0:
             evaluation_max = (-sys.maxint, None)
-            legal_moves = board.legal_moves
+            # Generate the moves up front since the board changes while
+            # children are searched
+            legal_moves = list(board.legal_moves)
             # Loop through and recurisvely find the best move,
             # using a certain evaluation function
             for move in legal_moves:
-                new_board = board.copy()
-                new_board.push_uci(move.uci())
+                board.push(move)
                 # Get the next move value and move
                 next_move_value = self.calculate_move_naive(
-                    new_board,
+                    board,
                     player+1, depth-1)[0]
+                board.pop()
                 # Set the max as needed
                 if next_move_value > evaluation_max[0]:
                     evaluation_max = (next_move_value, move)
             return evaluation_max
         else:
             evaluation_min = (sys.maxint, None)
-            legal_moves = board.legal_moves
+            # Generate the moves up front since the board changes while
+            # children are searched
+            legal_moves = list(board.legal_moves)
             # Loop through and recurisvely find the best move,
             # using a certain evaluation function
             for move in legal_moves:
-                new_board = board.copy()
-                new_board.push_uci(move.uci())
+                board.push(move)
                 # Get the next move value and move
                 next_move_value = self.calculate_move_naive(
-                    new_board,
+                    board,
                     player-1, depth-1)[0]
+                board.pop()
                 # Set the max as needed
                 if next_move_value < evaluation_min[0]:
                     evaluation_min = (next_move_value, move)
@@ -170,72 +419,727 @@ class Minimax:
 
 # Class that stores all the Negamax details
 class Negamax:
-    # Initializes the negamax class with input depth and tiemout
-    def __init__(self, depth=3, timeout = 30):
+    # Number of nodes searched between two looks at the clock. A node takes
+    # a fraction of a millisecond and time.time() far less, so a small
+    # interval keeps the overshoot past the hard deadline to a few
+    # milliseconds.
+    check_interval = 16
+    # Moves the remaining clock time is assumed to be spread over
+    moves_to_go = 30
+    # Seconds of the clock never budgeted, for unwinding an aborted search
+    # and getting the move to the other side
+    move_overhead = 0.05
+    # Width of the window used to test moves after the first one. Scores
+    # aren't integers, so this stands in for the usual one point.
+    null_window = 0.01
+    # Starting half-width of the aspiration window around the previous score
+    aspiration_window = 200
+    # Extra depth taken off the search after a null move
+    null_move_reduction = 2
+    # Quiet moves from this index in the move order on get reduced
+    lmr_min_index = 3
+    # How much a quiet move may gain over the static score at frontier nodes
+    futility_margin = 150
+
+    # Initializes the negamax class with input depth, tiemout, hash size in
+    # megabytes and the number of worker processes to split the root moves
+    # over. timeout is
+    # the hard limit that aborts a search, no new iteration is started after
+    # soft_timeout (by default the same as timeout). max_qdepth caps the
+    # quiescence search below the leaves, 0 turns it off. pvs and aspiration
+    # turn principal variation search and aspiration windows on or off,
+    # null_move, lmr and futility do the same for null move pruning, late
+    # move reductions and futility pruning. eval_cache_size is the evaluation
+    # cache size in megabytes, 0 turns it off. analysis_cache is the path of
+    # an analysis cache file that nodes searched at least
+    # analysis_cache_depth deep are looked up in and written back to.
+    def __init__(self, depth=3, timeout = 30, hash_size=16, workers=1,
+                 soft_timeout=None, max_qdepth=8, pvs=True, aspiration=True,
+                 null_move=True, lmr=True, futility=True, eval_cache_size=4,
+                 analysis_cache=None, analysis_cache_depth=4):
         self.depth = depth
         # Stores the previous levels' best move
         self.prev_best_moves = [None]*self.depth
         self.timeout = timeout
+        self.soft_timeout = timeout if soft_timeout is None else soft_timeout
+        # Nodes and quiescence nodes searched so far and when the current
+        # search has to stop
+        self.nodes = 0
+        self.qnodes = 0
+        self.hard_deadline = float("inf")
+        self.max_qdepth = max_qdepth
+        self.pvs = pvs
+        self.aspiration = aspiration
+        self.null_move = null_move
+        self.lmr = lmr
+        self.futility = futility
+        # Set to stop the search from another thread, shared with the workers
+        self.stop_flag = multiprocessing.RawValue("b", 0)
+        # True while searching on the opponent's time, the time limits of
+        # the search only start counting at ponderhit(). limits are the soft
+        # and hard limits of the current search and limits_start when they
+        # started counting.
+        self.pondering = False
+        self.limits = (self.soft_timeout, self.timeout)
+        self.limits_start = 0
+        # Counters and per-iteration results of the last search, its
+        # callback is called after every completed iteration
+        self.stats = search_stats.SearchStats()
+        # Kept across moves so later searches reuse earlier results
+        self.tt = transposition.TranspositionTable(hash_size)
+        self.eval_cache = evaluation.EvaluationCache(eval_cache_size) if eval_cache_size else None
+        self.ordering = move_ordering.MoveOrdering()
+        # Results of deep nodes kept on disk across runs, shared with the
+        # workers and any other process using the same file
+        self.analysis_cache = AnalysisCache(analysis_cache) if analysis_cache else None
+        self.analysis_cache_depth = analysis_cache_depth
+        # Principal variation table, allocated once for every search
+        self.stack = SearchStack()
+        # Numbers of the current game and search, sent with every root move
+        # so the workers age or clear their own tables when they change
+        self.game_id = 0
+        self.search_id = 0
+        # With more than one worker, root moves are searched in a process
+        # pool that shares the best root score found so far
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            self.shared_alpha = multiprocessing.Value("d", -sys.maxint)
+            self.pool = multiprocessing.Pool(workers, init_worker,
+                (depth, timeout, hash_size, max_qdepth, (null_move, lmr, futility),
+                 (analysis_cache, analysis_cache_depth), self.shared_alpha, self.stop_flag))
 
-    # Reset the best moves
+    # Shut down the worker processes, if any, and write out the analysis cache
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+        if self.analysis_cache:
+            self.analysis_cache.close()
+            self.analysis_cache = None
+
+    # Reset the best moves and age the transposition table
     def reset_caches(self):
+        self.search_id += 1
         self.prev_best_moves = [None]*self.depth
-    # Top level function that returns the most optimal move
-    def next_move(self, board):
+        self.tt.new_search()
+        self.ordering.new_search()
+        if self.eval_cache:
+            self.eval_cache.new_search()
+
+    # Forget everything learned in the previous game, the workers do the
+    # same at their next root move
+    def new_game(self):
+        self.game_id += 1
+        self.tt.clear()
+        self.ordering.clear()
+        if self.eval_cache:
+            self.eval_cache.clear()
+
+    # Makes a running search return the move of its last completed
+    # iteration. The flag stays set until the caller clears it before the
+    # next search.
+    def stop(self):
+        self.stop_flag.value = 1
+
+    # Tells a search started with ponder that the expected move was played.
+    # Its time limits count from now, and an iteration already running gets
+    # the hard deadline. Workers of a parallel search only see the deadline
+    # in the root moves they start after this.
+    def ponderhit(self):
+        self.limits_start = time.time()
+        self.pondering = False
+        if self.stats.iterations:
+            self.hard_deadline = self.limits_start + self.limits[1]
+
+    # Returns the soft and hard time limits in seconds for this move. With a
+    # game clock the budget is a share of the time left plus most of the
+    # increment, otherwise the fixed limits are used. move_overhead is kept
+    # back from the clock.
+    def time_limits(self, time_left=None, increment=0):
+        if time_left is None:
+            return (self.soft_timeout, self.timeout)
+        time_left = max(float(time_left) - self.move_overhead, 0.0)
+        budget = time_left/self.moves_to_go + 0.75*increment
+        # Never risk more than half of what is left on the clock
+        hard_limit = min(3*budget, 0.5*time_left)
+        return (min(budget, hard_limit), hard_limit)
+
+    # Top level function that returns the most optimal move. time_left and
+    # increment are the seconds on this side's clock, if playing on one.
+    # With ponder the search runs on the opponent's time: it ignores its
+    # time limits and holds on to its move until ponderhit() or stop(). The
+    # caller sets pondering to True before starting such a search in its own
+    # thread, so a ponderhit() that comes before the search gets going isn't
+    # lost.
+    def next_move(self, board, time_left=None, increment=0, ponder=False):
         # Reset the prev best moves and other caches
         self.reset_caches()
+        # Running material and piece-square totals for the searched board
+        self.evaluator = evaluation.IncrementalEvaluation(board, self.eval_cache)
         # Get the start time for the move
         start_time = time.time()
+        soft_limit, hard_limit = self.time_limits(time_left, increment)
+        self.limits = (soft_limit, hard_limit)
+        self.limits_start = start_time
+        if not ponder:
+            self.pondering = False
+        root_length = len(board.move_stack)
+        self.nodes = 0
+        self.qnodes = 0
+        self.stats.reset()
         evaluation_best = (-sys.maxint, None)
+        # Root score of every completed iteration
+        iteration_scores = []
         # Iterate over depths for iterative deepening
-        for iter_depth in range(1,self.depth):
-            # Check for timeout
-            if time.time() - start_time > self.timeout:
+        for iter_depth in range(1, self.depth + 1):
+            # Don't start an iteration after the soft limit or once stopped
+            if (not self.pondering and time.time() - self.limits_start > soft_limit) or self.stop_flag.value:
                 break
+            # The first iteration always finishes so there is a move to play.
+            # pondering is read after the deadline is reset, so a ponderhit()
+            # in between isn't lost.
+            self.hard_deadline = float("inf")
+            if iter_depth > 1 and not self.pondering:
+                self.hard_deadline = self.limits_start + hard_limit
             # Grab the potential next move
-            evaluation_temp = self.calculate_move(board, 1, iter_depth, -sys.maxint, sys.maxint, start_time)
-            # If it's the best so far, update and store it in the previous best move
-            if evaluation_temp[0] > evaluation_best[0]:
-                evaluation_best = evaluation_temp
-                self.prev_best_moves[self.depth - iter_depth] = evaluation_temp[1]
+            try:
+                if self.pool:
+                    evaluation_temp = self.calculate_root_parallel(board, iter_depth)
+                else:
+                    evaluation_temp = self.aspiration_search(board, iter_depth, iteration_scores)
+            except SearchAborted:
+                # Throw the unfinished iteration away and take back the
+                # moves it left on the board
+                while len(board.move_stack) > root_length:
+                    board.pop()
+                break
+            # Play the result of the deepest completed iteration
+            evaluation_best = evaluation_temp
+            iteration_scores.append(evaluation_temp[0])
+            self.prev_best_moves[self.depth - iter_depth] = evaluation_temp[1]
+            # Workers keep the lines of the moves they searched, so a
+            # parallel search follows the table instead
+            if self.pool:
+                pv = self.principal_variation(board, evaluation_temp[1], iter_depth)
+            else:
+                pv = self.stack.line()
+            self.stats.add_iteration(iter_depth, evaluation_temp[0], pv,
+                self.nodes, self.qnodes, self.tt, self.eval_cache, time.time() - start_time)
+
+        # A pondering search that reached its depth waits to be told what
+        # the opponent played
+        while self.pondering and not self.stop_flag.value:
+            time.sleep(0.01)
+        self.pondering = False
+
+        # Stopped before the first iteration finished, play the move that
+        # would have been searched first
+        if evaluation_best[1] is None and not board.is_game_over():
+            evaluation_best = (evaluation_best[0], next(self.order_moves(board, self.depth)))
 
         # Print out some useful information
         print "Turn: " + str(board.turn) + " Score: " + str(evaluation_best[0])
+        print "Nodes: " + str(self.nodes) + " QNodes: " + str(self.qnodes)
         print "Move Time: " + str(time.time() - start_time)
         return evaluation_best[1]
 
-    # Like minimax, function that actually recurses
-    def calculate_move(self, board, player, depth, alpha, beta, start_time):
-        # Check for depth limit, checkmate, or timeout
-        if depth == 0 or board.is_game_over() or ((time.time() - start_time) > self.timeout):
-            return (shannon_evalfn.evaluate(board), None)
+    # Like minimax, function that actually recurses. Returns the score and
+    # leaves the best move and the line after it in the stack at ply.
+    def calculate_move(self, board, player, depth, alpha, beta, ply=0):
+        # Only look at the clock every so often, it's too slow to do per node
+        self.nodes += 1
+        if self.nodes % self.check_interval == 0 and (time.time() > self.hard_deadline or self.stop_flag.value):
+            raise SearchAborted()
+        stack = self.stack
+        stack.pv_lengths[ply] = 0
+        # Check for checkmate or the depth limit
+        if game_over(board):
+            return self.evaluator.evaluate(board)
+        if depth == 0:
+            return quiesce(self, board, alpha, beta)
+        # Look the position up in the transposition table
+        key = board.zobrist_hash()
+        entry = self.tt.probe(key)
+        # Deep nodes the table can't answer are looked up in the analysis
+        # cache, which may hold a deeper result from an earlier run
+        if self.analysis_cache and depth >= self.analysis_cache_depth and (entry is None or entry[0] < depth):
+            cached = self.analysis_cache.probe(key)
+            if cached and (entry is None or cached[0] > entry[0]):
+                entry = cached
+        hash_move = None
+        if entry:
+            entry_depth, entry_score, entry_flag, hash_move = entry
+            if entry_depth >= depth:
+                if entry_flag == EXACT:
+                    stack.set_pv(ply, hash_move)
+                    return entry_score
+                elif entry_flag == LOWER:
+                    alpha = max(alpha, entry_score)
+                else:
+                    beta = min(beta, entry_score)
+                if alpha >= beta:
+                    stack.set_pv(ply, hash_move)
+                    return entry_score
+        in_check = board.is_check()
+        # If passing the turn and searching shallower still fails high, a real
+        # move would too. Not done twice in a row, or with only pawns left
+        # where zugzwang makes passing better than any move.
+        if (self.null_move and ply > 0 and depth > self.null_move_reduction and not in_check
+                and board.move_stack[-1].from_square != board.move_stack[-1].to_square
+                and evaluation.game_stage(board) < 2 and evaluation.has_pieces(board, board.turn)):
+            self.evaluator.push(board, null_move)
+            board.push(null_move)
+            null_value = -self.calculate_move(board, -player, depth-1-self.null_move_reduction,
+                -beta, -beta + self.null_window, ply+1)
+            board.pop()
+            self.evaluator.pop()
+            if null_value >= beta:
+                return null_value
+        # At frontier nodes quiet moves that can't lift the score up to alpha
+        # are skipped. The evaluation only scores the side to move, so a
+        # quiet move's score is estimated by passing the turn instead of from
+        # this node's own static score.
+        futile = False
+        if self.futility and depth == 1 and not in_check:
+            self.evaluator.push(board, null_move)
+            board.push(null_move)
+            # Only whether the score reaches the threshold matters
+            threshold = self.futility_margin - alpha
+            futile = -self.evaluator.evaluate(board, threshold, threshold) + self.futility_margin <= alpha
+            board.pop()
+            self.evaluator.pop()
         new_alpha = alpha
         new_beta = beta
-        evaluation_best = (-sys.maxint, None)
-        # Order the move list based on the previous iteration
-        move_list = self.order_moves(board, depth)
+        best_value = -sys.maxint
+        best_move = None
+        # Order the move list based on the hash move and previous iteration
+        move_list = self.order_moves(board, depth, hash_move, ply)
         # Iterate through, recurse, and find the best move
-        for move in move_list:
-            new_board = board.copy()
-            new_board.push_uci(move.uci())
-
-            next_move_value = -self.calculate_move(new_board, -player, depth-1, -new_beta, -new_alpha, start_time)[0]
-            if next_move_value > evaluation_best[0]:
-                evaluation_best = (next_move_value, move)
+        for index, move in enumerate(move_list):
+            quiet = not move.promotion and not board.is_capture(move)
+            # Make the move in place and take it back after the recursion
+            self.evaluator.push(board, move)
+            board.push(move)
+            quiet = quiet and not board.is_check()
+            if futile and index > 0 and quiet:
+                board.pop()
+                self.evaluator.pop()
+                continue
+            # Quiet moves late in the order are searched one ply
+            # shallower first, and again at full depth if they beat alpha
+            reduction = 0
+            if self.lmr and index >= self.lmr_min_index and depth >= 3 and not in_check and quiet:
+                reduction = 1
+            if index == 0:
+                next_move_value = -self.calculate_move(board, -player, depth-1, -new_beta, -new_alpha, ply+1)
+            else:
+                if reduction:
+                    next_move_value = -self.calculate_move(board, -player, depth-1-reduction,
+                        -new_alpha - self.null_window, -new_alpha, ply+1)
+                if not reduction or next_move_value > new_alpha:
+                    if not self.pvs:
+                        next_move_value = -self.calculate_move(board, -player, depth-1, -new_beta, -new_alpha, ply+1)
+                    else:
+                        # Later moves only need to be proven worse than the
+                        # best so far, so search them with a null window and
+                        # do the full search again if that fails
+                        next_move_value = -self.calculate_move(board, -player, depth-1,
+                            -new_alpha - self.null_window, -new_alpha, ply+1)
+                        if new_alpha < next_move_value < new_beta:
+                            next_move_value = -self.calculate_move(board, -player, depth-1,
+                                -new_beta, -new_alpha, ply+1)
+            board.pop()
+            self.evaluator.pop()
+            if next_move_value > best_value:
+                best_value = next_move_value
+                best_move = move
+                stack.update_pv(ply, move)
             # Update alpha and break if needed
-            new_alpha = max(new_alpha, next_move_value)
+            if next_move_value > new_alpha:
+                new_alpha = next_move_value
             if new_alpha >= new_beta:
+                self.ordering.update(board, move, depth, ply)
+                self.stats.cutoff(index)
                 break
+        if best_value <= alpha:
+            flag = UPPER
+        elif best_value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.tt.store(key, depth, best_value, flag, best_move)
+        if self.analysis_cache and depth >= self.analysis_cache_depth:
+            self.analysis_cache.store(key, depth, best_value, flag, best_move)
+        return best_value
+
+    # Searches the root with a window around the score of the iteration two
+    # plies shallower. The evaluation only scores the side to move's own
+    # pieces, so scores swing between odd and even depths and the previous
+    # iteration is a poor guess. Whichever side of the window the score falls
+    # out of is widened, twice as far each time, until it lands inside.
+    # Returns the root score and best move.
+    def aspiration_search(self, board, depth, iteration_scores):
+        if not self.aspiration or len(iteration_scores) < 2:
+            return self.root_result(self.calculate_move(board, 1, depth, -sys.maxint, sys.maxint))
+        previous_score = iteration_scores[-2]
+        delta = self.aspiration_window
+        alpha = max(previous_score - delta, -sys.maxint)
+        beta = min(previous_score + delta, sys.maxint)
+        while True:
+            value = self.calculate_move(board, 1, depth, alpha, beta)
+            if value <= alpha and alpha > -sys.maxint:
+                alpha = max(alpha - delta, -sys.maxint)
+            elif value >= beta and beta < sys.maxint:
+                beta = min(beta + delta, sys.maxint)
+            else:
+                return self.root_result(value)
+            delta *= 2
+
+    # Pairs the score of a root search with the best move it left in the stack
+    def root_result(self, value):
+        return (value, self.stack.pv[0][0] if self.stack.pv_lengths[0] else None)
+
+    # Searches the root with its moves split over the worker pool. The first
+    # move is searched here to get a bound, then the rest are handed out one
+    # at a time, each searched against the best score found so far.
+    def calculate_root_parallel(self, board, depth):
+        if board.is_game_over():
+            return (self.evaluator.evaluate(board), None)
+        move_list = list(self.order_moves(board, depth))
+        first_move = move_list[0]
+        self.evaluator.push(board, first_move)
+        board.push(first_move)
+        first_value = -self.calculate_move(board, -1, depth-1, -sys.maxint, sys.maxint, 1)
+        board.pop()
+        self.evaluator.pop()
+        evaluation_best = (first_value, first_move)
+
+        self.shared_alpha.value = first_value
+        fen = board.fen()
+        tasks = [(fen, move.uci(), depth, self.hard_deadline, self.game_id, self.search_id)
+                 for move in move_list[1:]]
+        results = self.pool.map(search_root_move, tasks, 1)
+        # The iteration is only usable if every worker finished in time
+        if None in results:
+            raise SearchAborted()
+        # Scores at or below the alpha a move was searched with are only
+        # upper bounds, so those moves can't be the best
+        for move, (value, alpha, nodes, qnodes) in zip(move_list[1:], results):
+            self.nodes += nodes
+            self.qnodes += qnodes
+            if value > alpha and value > evaluation_best[0]:
+                evaluation_best = (value, move)
         return evaluation_best
 
-    # Returns a move list where the best move from the previou iteration is put in front
-    def order_moves(self, board, depth):
-        prev_best_move = self.prev_best_moves[self.depth - depth]
-        # Put the mvoes in a regular list
-        move_list = [move for move in board.legal_moves]
-        # Put the best move for that node level at the front
-        # Check if the move as has been populated
-        if prev_best_move != None and prev_best_move in move_list:
-            move_list.insert(0, move_list.pop(move_list.index(prev_best_move)))
-        return move_list
+    # Follows the best moves stored in the transposition table from the root
+    # move on, up to depth moves long
+    def principal_variation(self, board, move, depth):
+        pv = []
+        while move is not None and len(pv) < depth and board.is_legal(move):
+            pv.append(move)
+            board.push(move)
+            entry = self.tt.probe(board.zobrist_hash())
+            move = entry[3] if entry else None
+        for pv_move in pv:
+            board.pop()
+        return pv
+
+    # Returns the moves in the order they should be searched, starting with
+    # the hash move, or else the best move from the previous iteration
+    def order_moves(self, board, depth, hash_move=None, ply=0):
+        if hash_move == None:
+            hash_move = self.prev_best_moves[self.depth - depth]
+        return self.ordering.pick_moves(board, hash_move, ply)
+
+# Negamax instance owned by each worker process of a parallel search
+worker_search = None
+# Best root score found so far, shared by all the workers
+worker_alpha = None
+
+# Sets up a worker process with its own search and transposition table
+def init_worker(depth, timeout, hash_size, max_qdepth, selectivity, cache_settings,
+                shared_alpha, stop_flag):
+    global worker_search, worker_alpha
+    null_move, lmr, futility = selectivity
+    analysis_cache, analysis_cache_depth = cache_settings
+    worker_search = Negamax(depth, timeout, hash_size, max_qdepth=max_qdepth,
+                            null_move=null_move, lmr=lmr, futility=futility,
+                            analysis_cache=analysis_cache, analysis_cache_depth=analysis_cache_depth)
+    worker_search.stop_flag = stop_flag
+    worker_alpha = shared_alpha
+
+# Searches one root move in a worker and returns its score along with the
+# alpha it was searched with and the nodes and quiescence nodes used, or None
+# if the deadline passed or the search was stopped
+def search_root_move(task):
+    fen, move_uci, depth, deadline, game_id, search_id = task
+    # Moves still queued when the search is stopped aren't started
+    if worker_search.stop_flag.value:
+        return None
+    # The main process may have been given a deeper depth than the worker
+    # was started with, the worker's best moves have to cover it
+    if depth != worker_search.depth:
+        worker_search.depth = depth
+        worker_search.prev_best_moves = [None]*depth
+    # The first root move of a new game or search clears or ages the
+    # worker's tables like the main process did with its own
+    if game_id != worker_search.game_id:
+        worker_search.new_game()
+        worker_search.game_id = game_id
+    if search_id != worker_search.search_id:
+        worker_search.reset_caches()
+        worker_search.search_id = search_id
+    board = chess.Board(fen)
+    move = chess.Move.from_uci(move_uci)
+    worker_search.evaluator = evaluation.IncrementalEvaluation(board, worker_search.eval_cache)
+    worker_search.evaluator.push(board, move)
+    board.push(move)
+    alpha = worker_alpha.value
+    worker_search.hard_deadline = deadline
+    worker_search.nodes = 0
+    worker_search.qnodes = 0
+    try:
+        value = -worker_search.calculate_move(board, -1, depth-1, -sys.maxint, -alpha, 1)
+    except SearchAborted:
+        return None
+    # Raise the shared bound for the moves still being searched
+    with worker_alpha.get_lock():
+        if value > worker_alpha.value:
+            worker_alpha.value = value
+    return (value, alpha, worker_search.nodes, worker_search.qnodes)
+
+# Monte Carlo tree search. The tree is kept in preallocated arrays indexed by
+# node number instead of one object per node, and the children of a node
+# take up consecutive slots so a whole child list is scored in one numpy
+# call. Node values are the share of the points won by the side that made
+# the node's move.
+class MCTS:
+    # Exploration constant of the UCT formula
+    exploration = 1.4
+    # Difference between the two sides' scores that is worth 10 to 1 odds
+    # when a leaf evaluation is turned into a winning chance. A pawn is
+    # worth about 190 in the difference, so this is close to the usual 400
+    # centipawns.
+    eval_scale = 800.0
+    # Longest random playout before the game is counted as a draw
+    max_rollout = 200
+    # Playouts between two looks at the clock
+    check_interval = 16
+
+    # Initializes with the number of playouts per move, the time limit in
+    # seconds, the number of worker processes that grow their own trees
+    # and merge them at the root, whether leaves are scored with the shannon
+    # evaluation instead of playing random moves to the end of the game,
+    # and how many nodes the tree has room for
+    def __init__(self, playouts=2000, timeout=30, workers=1, leaf_eval=True, max_nodes=200000):
+        self.playouts = playouts
+        self.timeout = timeout
+        self.leaf_eval = leaf_eval
+        self.max_nodes = max_nodes
+        self.rollout_policy = Random()
+        # Parent, packed move, first child and number of children of every
+        # node, a node without children has not been expanded yet
+        self.parents = numpy.zeros(max_nodes, dtype=numpy.int32)
+        self.moves = numpy.zeros(max_nodes, dtype=numpy.uint16)
+        self.first_children = numpy.zeros(max_nodes, dtype=numpy.int32)
+        self.child_counts = numpy.zeros(max_nodes, dtype=numpy.int32)
+        # Visits and points won, as floats so UCT is computed without casts
+        self.visits = numpy.zeros(max_nodes, dtype=numpy.float64)
+        self.values = numpy.zeros(max_nodes, dtype=numpy.float64)
+        self.node_count = 0
+        # Playouts run for the last move, over all workers
+        self.nodes = 0
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers, init_mcts_worker, (leaf_eval, max_nodes))
+
+    # Shut down the worker processes, if any
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+    # Empties the tree down to an unexpanded root
+    def reset(self):
+        self.parents[0] = -1
+        self.child_counts[0] = 0
+        self.visits[0] = 0
+        self.values[0] = 0
+        self.node_count = 1
+
+    # Adds a child for every legal move of board below node, in random
+    # order so parallel trees don't all try the same moves first. Returns
+    # False if there are no moves or the tree is full.
+    def expand(self, node, board):
+        moves = [transposition.encode_move(move) for move in board.legal_moves]
+        start = self.node_count
+        end = start + len(moves)
+        if not moves or end > self.max_nodes:
+            return False
+        random.shuffle(moves)
+        self.parents[start:end] = node
+        self.moves[start:end] = moves
+        self.child_counts[start:end] = 0
+        self.visits[start:end] = 0
+        self.values[start:end] = 0
+        self.first_children[node] = start
+        self.child_counts[node] = len(moves)
+        self.node_count = end
+        return True
+
+    # Picks the child of node with the highest UCT score, children that
+    # were never visited come first
+    def select_child(self, node):
+        start = self.first_children[node]
+        visits = self.visits[start:start + self.child_counts[node]]
+        unvisited = numpy.flatnonzero(visits == 0)
+        if len(unvisited):
+            return start + int(unvisited[0])
+        uct = self.values[start:start + len(visits)]/visits + \
+            self.exploration*numpy.sqrt(math.log(self.visits[node])/visits)
+        return start + int(numpy.argmax(uct))
+
+    # Share of the points the side to move can expect from board: the game
+    # result when it's over, the evaluation as a winning chance, or the
+    # result of a random playout
+    def leaf_value(self, board):
+        if board.is_game_over():
+            # The only decisive way to end is the side to move getting mated
+            return 0.5 if board.result() == "1/2-1/2" else 0.0
+        if self.leaf_eval:
+            # The evaluation only scores the side to move, so the other
+            # side's score is taken by passing the turn, like the futility
+            # pruning does, and the difference is what decides the game.
+            # Passing out of check would leave the king to be taken, so a
+            # side in check is scored directly, doubled since the material
+            # counts twice in the difference.
+            score = shannon_evalfn.evaluate(board)
+            if board.is_check():
+                score *= 2
+            else:
+                board.push(null_move)
+                score -= shannon_evalfn.evaluate(board)
+                board.pop()
+            return 1.0/(1.0 + 10**(-score/self.eval_scale))
+        turn = board.turn
+        plies = 0
+        while plies < self.max_rollout and not board.is_game_over():
+            board.push(self.rollout_policy.next_move(board))
+            plies += 1
+        result = board.result()
+        for ply in range(plies):
+            board.pop()
+        if result in ("1-0", "0-1"):
+            return 1.0 if (result == "1-0") == turn else 0.0
+        return 0.5
+
+    # One playout: walk down the tree by UCT, expand the leaf if it was
+    # visited before, score it and add the result to every node on the way
+    def playout(self, board):
+        node = 0
+        depth = 0
+        while self.child_counts[node] > 0:
+            node = self.select_child(node)
+            board.push(transposition.decode_move(int(self.moves[node])))
+            depth += 1
+        if (node == 0 or self.visits[node] > 0) and self.expand(node, board):
+            node = self.select_child(node)
+            board.push(transposition.decode_move(int(self.moves[node])))
+            depth += 1
+        value = self.leaf_value(board)
+        for ply in range(depth):
+            board.pop()
+        # value is for the side to move at the leaf, each node keeps the
+        # points of the side that moved into it
+        while node >= 0:
+            value = 1.0 - value
+            self.visits[node] += 1
+            self.values[node] += value
+            node = self.parents[node]
+
+    # Grows a new tree from board for up to playouts playouts or until the
+    # deadline. The first playout always runs, so the root is expanded.
+    # Returns the number of playouts run.
+    def search(self, board, playouts, deadline):
+        self.reset()
+        for playout in range(playouts):
+            if playout and playout % self.check_interval == 0 and time.time() > deadline:
+                return playout
+            self.playout(board)
+        return playouts
+
+    # Returns (move, visits, points) for every child of the root
+    def root_children(self):
+        start = self.first_children[0]
+        return [(transposition.decode_move(int(self.moves[child])), int(self.visits[child]),
+                 float(self.values[child])) for child in range(start, start + self.child_counts[0])]
+
+    # Returns the most visited root move, with workers every process grows
+    # its own tree for a share of the playouts and the root visits are added
+    # up
+    def next_move(self, board):
+        start_time = time.time()
+        deadline = start_time + self.timeout
+        if self.pool:
+            fen = board.fen()
+            tasks = [(fen, self.playouts // self.workers + (1 if index < self.playouts % self.workers else 0),
+                      deadline, randint(0, sys.maxint)) for index in range(self.workers)]
+            totals = {}
+            self.nodes = 0
+            tree_nodes = 0
+            for playouts, node_count, children in self.pool.map(mcts_root_playouts, tasks, 1):
+                self.nodes += playouts
+                tree_nodes += node_count
+                for move_uci, visits, points in children:
+                    total = totals.get(move_uci, (0, 0.0))
+                    totals[move_uci] = (total[0] + visits, total[1] + points)
+            children = [(chess.Move.from_uci(move_uci), visits, points)
+                        for move_uci, (visits, points) in totals.items()]
+        else:
+            self.nodes = self.search(board, self.playouts, deadline)
+            tree_nodes = self.node_count
+            children = self.root_children()
+        # No playout ran, any legal move will do
+        if not children:
+            return next(iter(board.legal_moves), None)
+        move, visits, points = max(children, key=lambda child: child[1])
+
+        print "Turn: " + str(board.turn) + " Win chance: " + str(points/visits if visits else 0.5)
+        print "Playouts: " + str(self.nodes) + " Tree nodes: " + str(tree_nodes)
+        print "Move Time: " + str(time.time() - start_time)
+        return move
+
+# MCTS instance owned by each worker process of a root-parallel search
+worker_mcts = None
+
+# Sets up a worker process with its own tree
+def init_mcts_worker(leaf_eval, max_nodes):
+    global worker_mcts
+    worker_mcts = MCTS(leaf_eval=leaf_eval, max_nodes=max_nodes)
+
+# Grows a tree from the position in a worker and returns the number of
+# playouts run and tree nodes used with (move, visits, points) for every
+# root move
+def mcts_root_playouts(task):
+    fen, playouts, deadline, seed = task
+    # Forked workers start with the same random state
+    random.seed(seed)
+    run = worker_mcts.search(chess.Board(fen), playouts, deadline)
+    return (run, worker_mcts.node_count, [(move.uci(), visits, points) for move, visits, points in worker_mcts.root_children()])
+
+# Times a search of board to the given depth with one worker and then with
+# workers processes. Returns both times and the speedup.
+def parallel_speedup(board, depth, workers, timeout=3600):
+    serial = Negamax(depth, timeout)
+    start_time = time.time()
+    serial.next_move(board)
+    serial_time = time.time() - start_time
 
+    parallel = Negamax(depth, timeout, workers=workers)
+    start_time = time.time()
+    parallel.next_move(board)
+    parallel_time = time.time() - start_time
+    parallel.close()
+    return (serial_time, parallel_time, serial_time/parallel_time)
@@ -2,7 +2,9 @@
 
 # Libraries
 import evaluation_factors
+import numpy
 import sys
+import time
 import chess
 import chess.syzygy
 
@@ -12,14 +14,51 @@ piece_svalue_dict = {1: 100, 2: 320, 3: 330, 4: 500, 5: 900, 6: 0}
 central_squares =   [chess.C3, chess.C4, chess.C5, chess.C6, chess.D3, chess.D4, chess.D5, chess.D6,
                     chess.E3, chess.E4, chess.E5, chess.E6, chess.F3, chess.F4, chess.F5, chess.F6]
 
+# Piece-square tables indexed by color, then piece type
+pos_value_tables = {
+    chess.WHITE: [None, evaluation_factors.w_pawn_pos_value, evaluation_factors.w_knight_pos_value,
+                  evaluation_factors.w_bishop_pos_value, evaluation_factors.w_rook_pos_value,
+                  evaluation_factors.w_queen_pos_value, evaluation_factors.w_king_midgame_pos_value],
+    chess.BLACK: [None, evaluation_factors.b_pawn_pos_value, evaluation_factors.b_knight_pos_value,
+                  evaluation_factors.b_bishop_pos_value, evaluation_factors.b_rook_pos_value,
+                  evaluation_factors.b_queen_pos_value, evaluation_factors.b_king_midgame_pos_value]}
+
 # Open tablebase file
 tablebases = chess.syzygy.open_tablebases()
 
+# Builds the mask of squares reached by walking from square in the given
+# direction and its opposite, including the square itself
+def line_mask(square, file_step, rank_step):
+    mask = chess.BB_SQUARES[square]
+    for sign in (1, -1):
+        file_index = chess.file_index(square) + sign*file_step
+        rank_index = chess.rank_index(square) + sign*rank_step
+        while 0 <= file_index < 8 and 0 <= rank_index < 8:
+            mask |= chess.BB_SQUARES[chess.square(file_index, rank_index)]
+            file_index += sign*file_step
+            rank_index += sign*rank_step
+    return mask
+
+# Straight (rank and file) and diagonal lines through every square
+straight_lines = [(line_mask(square, 0, 1), line_mask(square, 1, 0)) for square in chess.SQUARES]
+diagonal_lines = [(line_mask(square, 1, 1), line_mask(square, 1, -1)) for square in chess.SQUARES]
+
+# Number of set bits in a bitboard
+def pop_count(mask):
+    return bin(mask).count("1")
+
+# Yields the squares of the set bits in a bitboard
+def mask_squares(mask):
+    while mask:
+        square_bit = mask & -mask
+        yield square_bit.bit_length() - 1
+        mask ^= square_bit
+
 # 0 = early game
 # 1 = middle game
 # 2 = late game
 def game_stage(board):
-    piece_count = sum([1 for square in chess.SQUARES if board.piece_at(square)])
+    piece_count = pop_count(board.occupied)
     if piece_count > 28:
         return 0
     elif piece_count > 12:
@@ -27,6 +66,11 @@ def game_stage(board):
     else:
         return 2
 
+# Whether color has any pieces besides pawns and its king. Without them
+# zugzwang is common, so passing the turn can't stand in for a real move.
+def has_pieces(board, color):
+    return bool(board.occupied_co[color] & ~(board.pawns | board.kings))
+
 # Adds a huge bonus for checkmate moves
 def checkmate_score(board):
     # If it's checkmate, and the player wins
@@ -176,7 +220,27 @@ def open_knight_penalty(board):
     # Return the pawn-scaled knight value
     return total_k_val*(1.0 - pawn_count/8.0)
 
-# Class that stores the two evluation functions
+# Squares that could be pinned to the king of the side to move. Only squares
+# on a rank, file or diagonal through the king that also holds an enemy
+# slider moving along it can be pinned, so the rest are never checked.
+def pin_candidates(board):
+    king_mask = board.pieces_mask(chess.KING, board.turn)
+    if not king_mask:
+        return chess.BB_VOID
+    king_square = king_mask.bit_length() - 1
+    enemy = board.occupied_co[not board.turn]
+    straight_sliders = (board.rooks | board.queens) & enemy
+    diagonal_sliders = (board.bishops | board.queens) & enemy
+    candidates = chess.BB_VOID
+    for line in straight_lines[king_square]:
+        if line & straight_sliders:
+            candidates |= line
+    for line in diagonal_lines[king_square]:
+        if line & diagonal_sliders:
+            candidates |= line
+    return candidates
+
+# Class that stores the evluation functions
 class Evaluation:
 
     evaluation_fn = None
@@ -187,6 +251,8 @@ class Evaluation:
             self.evaluate = self.naive
         elif evaluation_fn == "shannon":
             self.evaluate = self.shannon
+        elif evaluation_fn == "bitboard":
+            self.evaluate = self.bitboard
 
     # Simple naive evaluation function based on only material value
     def naive(self, board):
@@ -217,3 +283,336 @@ class Evaluation:
 
         # Take into account attacking ability
         return board_value
+
+    # Same score as shannon, but every term is computed in one pass over the
+    # piece bitboards instead of separate loops over all 64 squares
+    def bitboard(self, board):
+        turn = board.turn
+        tables = pos_value_tables[turn]
+        own_counts = [0]*7
+        material = 0
+        position = 0
+        aggression = 0
+        # Count pieces and sum up the tables and attacks of friendly pieces
+        for piece_type in range(1, 7):
+            own_mask = board.pieces_mask(piece_type, turn)
+            own_counts[piece_type] = pop_count(own_mask)
+            material += piece_svalue_dict[piece_type]*(
+                own_counts[piece_type] - pop_count(board.pieces_mask(piece_type, not turn)))
+            table = tables[piece_type]
+            for square in mask_squares(own_mask):
+                position += table[square]
+                aggression += pop_count(board.attacks_mask(square))
+        return shannon_sum(board, material, own_counts, position, aggression)
+
+# Number of squares attacked by the pieces of the side to move
+def attack_count(board):
+    aggression = 0
+    for square in mask_squares(board.occupied_co[board.turn]):
+        aggression += pop_count(board.attacks_mask(square))
+    return aggression
+
+# Returns the checkmate, mobility and pin terms, which need legal move
+# generation or attack lookups on the whole position
+def dynamic_terms(board):
+    # Legal move count doubles as the checkmate test
+    mobility = len(board.legal_moves)
+    checkmate = -20000 if mobility == 0 and board.is_check() else 0
+
+    pins = 0
+    for square in mask_squares(pin_candidates(board)):
+        if board.is_pinned(board.turn, square):
+            pins += 1
+    return checkmate, mobility, pins
+
+# Returns the piece pair and queen bonuses, the open rook and bishop bonus,
+# the double pawn penalty and the open knight penalty, which only need piece
+# counts and bitboards
+def piece_terms(board, own_counts):
+    # Friendly pieces with a pawn of either color right in front of them
+    own = board.occupied_co[board.turn]
+    double_pawns = pop_count(((own & ~chess.BB_RANKS[7]) << 8) & board.pawns)
+
+    # Pawn-scaled values of the friendly knights, bishops and rooks
+    pawn_count = own_counts[chess.PAWN]
+    open_rook_bishop = own_counts[chess.BISHOP]*piece_svalue_dict[chess.BISHOP]*(1.0 - pawn_count/8.0)
+    open_rook_bishop += own_counts[chess.ROOK]*piece_svalue_dict[chess.ROOK]*(1.0 - pawn_count/8.0)
+    open_knight = own_counts[chess.KNIGHT]*piece_svalue_dict[chess.KNIGHT]*(1.0 - pawn_count/8.0)
+
+    bonuses = 0
+    bonuses += 100 if own_counts[chess.KNIGHT] == 2 else 0
+    bonuses += 100 if own_counts[chess.BISHOP] == 2 else 0
+    bonuses += 100 if own_counts[chess.ROOK] == 2 else 0
+    bonuses += 100*own_counts[chess.QUEEN]
+    return bonuses, open_rook_bishop, double_pawns, open_knight
+
+# Most squares a piece of each type can attack, and most legal moves and
+# pinned pieces a position can have. They bound the terms a lazy
+# evaluation hasn't computed yet.
+max_attacks = [0, 2, 8, 13, 14, 27, 8]
+max_mobility = 218
+max_pins = 8
+
+# Combines the shannon terms given the ones that are cheap to keep track of.
+# The rest need the whole position and are computed from the bitboards.
+# Terms are added in the same order as shannon so the floating point result
+# is identical.
+def shannon_sum(board, material, own_counts, position, aggression):
+    checkmate, mobility, pins = dynamic_terms(board)
+    bonuses, open_rook_bishop, double_pawns, open_knight = piece_terms(board, own_counts)
+
+    board_value = 0
+    board_value += checkmate
+    board_value += material
+    board_value += bonuses
+    board_value += 0.5*position
+    board_value += 0.2*mobility
+    board_value += 0.2*aggression
+    board_value += 0.05*open_rook_bishop
+
+    board_value -= double_pawns
+    board_value -= pins
+    board_value -= 0.05*open_knight
+    return board_value
+
+# Fixed-size table of evaluations keyed by the board's Zobrist hash. Each
+# key has one slot and a new score always replaces the old one there. The
+# key covers the side to move, castling and en passant, which is everything
+# besides the pieces that the evaluation looks at.
+class EvaluationCache:
+
+    # Initialize the table to fit into roughly size_mb megabytes
+    def __init__(self, size_mb=4):
+        self.size = max(1, int(size_mb * 1024 * 1024) // 17)
+        self.keys = numpy.zeros(self.size, dtype=numpy.uint64)
+        self.scores = numpy.zeros(self.size, dtype=numpy.float64)
+        self.filled = numpy.zeros(self.size, dtype=numpy.bool_)
+        # Probes and probes that found their key since the last new_search
+        self.probes = 0
+        self.hits = 0
+
+    # Empty every slot
+    def clear(self):
+        self.filled.fill(False)
+
+    # Start counting probes and hits for a new search, the scores are kept
+    def new_search(self):
+        self.probes = 0
+        self.hits = 0
+
+    # Returns the cached score for the key, or None on a miss
+    def probe(self, key):
+        index = key % self.size
+        self.probes += 1
+        if not self.filled.item(index) or self.keys.item(index) != key:
+            return None
+        self.hits += 1
+        return self.scores.item(index)
+
+    # Stores the score of the key
+    def store(self, key, score):
+        index = key % self.size
+        self.keys[index] = key
+        self.scores[index] = score
+        self.filled[index] = True
+
+# Keeps material, piece-square and piece count totals for both colors up to
+# date as the search makes and takes back moves, so leaves don't have to
+# recompute them. Call push before the move is pushed on the board and pop
+# after it is popped.
+class IncrementalEvaluation:
+
+    """Most pieces a move changes: castling removes and adds two"""
+    max_changes = 4
+    """Moves the change records are allocated for up front"""
+    max_ply = 128
+
+    # Compute the totals from scratch for the starting board. Scores are
+    # looked up in and saved to cache, if given.
+    def __init__(self, board, cache=None):
+        self.cache = cache
+        self.material = {chess.WHITE: 0, chess.BLACK: 0}
+        self.position = {chess.WHITE: 0, chess.BLACK: 0}
+        self.counts = {chess.WHITE: [0]*7, chess.BLACK: [0]*7}
+        # Changes made by each pushed move, so they can be undone. They are
+        # kept in flat lists with max_changes slots per move instead of a
+        # list of tuples per move, so pushing a move builds no new objects.
+        self.ply = 0
+        self.change_colors = [False]*(self.max_changes*self.max_ply)
+        self.change_types = [0]*(self.max_changes*self.max_ply)
+        self.change_squares = [0]*(self.max_changes*self.max_ply)
+        self.change_signs = [0]*(self.max_changes*self.max_ply)
+        # End of the slots used by the move at each ply
+        self.change_ends = [0]*self.max_ply
+        for color in chess.COLORS:
+            for piece_type in range(1, 7):
+                for square in mask_squares(board.pieces_mask(piece_type, color)):
+                    self.update(color, piece_type, square, 1)
+
+    # Adds (sign 1) or removes (sign -1) a piece from the totals
+    def update(self, color, piece_type, square, sign):
+        self.material[color] += sign*piece_svalue_dict[piece_type]
+        self.position[color] += sign*pos_value_tables[color][piece_type][square]
+        self.counts[color][piece_type] += sign
+
+    # Applies a change and records it in slot, returns the next free slot
+    def record(self, slot, color, piece_type, square, sign):
+        self.change_colors[slot] = color
+        self.change_types[slot] = piece_type
+        self.change_squares[slot] = square
+        self.change_signs[slot] = sign
+        self.material[color] += sign*piece_svalue_dict[piece_type]
+        self.position[color] += sign*pos_value_tables[color][piece_type][square]
+        self.counts[color][piece_type] += sign
+        return slot + 1
+
+    # Apply the piece changes of a move that is about to be made
+    def push(self, board, move):
+        ply = self.ply
+        if ply == len(self.change_ends):
+            # Deeper than expected, make room for as many moves again
+            self.change_colors += self.change_colors
+            self.change_types += self.change_types
+            self.change_squares += self.change_squares
+            self.change_signs += self.change_signs
+            self.change_ends += self.change_ends
+        color = board.turn
+        slot = ply*self.max_changes
+        # A null move passes the turn and leaves every piece where it is,
+        # it's the only move that starts and ends on the same square
+        if move.from_square == move.to_square:
+            pass
+        elif board.is_castling(move):
+            # Castling is encoded either as a two square king move or as the
+            # king capturing its own rook
+            rank_index = chess.rank_index(move.from_square)
+            kingside = chess.file_index(move.to_square) > chess.file_index(move.from_square)
+            if board.piece_type_at(move.to_square) == chess.ROOK:
+                rook_from = move.to_square
+            else:
+                rook_from = chess.square(7 if kingside else 0, rank_index)
+            slot = self.record(slot, color, chess.KING, move.from_square, -1)
+            slot = self.record(slot, color, chess.ROOK, rook_from, -1)
+            slot = self.record(slot, color, chess.KING, chess.square(6 if kingside else 2, rank_index), 1)
+            slot = self.record(slot, color, chess.ROOK, chess.square(5 if kingside else 3, rank_index), 1)
+        else:
+            piece_type = board.piece_type_at(move.from_square)
+            captured_type = board.piece_type_at(move.to_square)
+            if captured_type:
+                slot = self.record(slot, not color, captured_type, move.to_square, -1)
+            elif piece_type == chess.PAWN and move.to_square == board.ep_square:
+                # En passant, the captured pawn is behind the target square
+                slot = self.record(slot, not color, chess.PAWN, move.to_square + (-8 if color else 8), -1)
+            slot = self.record(slot, color, piece_type, move.from_square, -1)
+            slot = self.record(slot, color, move.promotion or piece_type, move.to_square, 1)
+        self.change_ends[ply] = slot
+        self.ply = ply + 1
+
+    # Undo the changes of the last pushed move
+    def pop(self):
+        self.ply -= 1
+        start = self.ply*self.max_changes
+        slot = self.change_ends[self.ply]
+        while slot > start:
+            slot -= 1
+            self.update(self.change_colors[slot], self.change_types[slot],
+                        self.change_squares[slot], -self.change_signs[slot])
+
+    # Shannon score of the board, reading material and piece-square totals
+    # from the running state. Given an alpha-beta window the terms are added
+    # from cheapest to most expensive, and once the ones left can't bring the
+    # score back into the window a bound is returned instead: an upper bound
+    # below alpha or a lower bound above beta. Only exact scores are cached.
+    def evaluate(self, board, alpha=-sys.maxint, beta=sys.maxint):
+        if self.cache:
+            key = board.zobrist_hash()
+            score = self.cache.probe(key)
+            if score is not None:
+                return score
+        turn = board.turn
+        material = self.material[turn] - self.material[not turn]
+        counts = self.counts[turn]
+        position = self.position[turn]
+        aggression = None
+        # The checkmate term can only be ruled out when not in check
+        if (alpha > -sys.maxint or beta < sys.maxint) and not board.is_check():
+            bonuses, open_rook_bishop, double_pawns, open_knight = piece_terms(board, counts)
+            static = (material + bonuses + 0.5*position + 0.05*open_rook_bishop
+                      - double_pawns - 0.05*open_knight)
+            low = static - max_pins
+            if low > beta:
+                return low
+            most_attacks = sum([max_attacks[piece_type]*counts[piece_type] for piece_type in range(1, 7)])
+            high = static + 0.2*max_mobility + 0.2*most_attacks
+            if high < alpha:
+                return high
+            # Attacks are cheap next to legal move generation, count them
+            # and try again
+            aggression = attack_count(board)
+            low += 0.2*aggression
+            if low > beta:
+                return low
+            high = static + 0.2*max_mobility + 0.2*aggression
+            if high < alpha:
+                return high
+        if aggression is None:
+            aggression = attack_count(board)
+        score = shannon_sum(board, material, counts, position, aggression)
+        if self.cache:
+            self.cache.store(key, score)
+        return score
+
+# Evaluation terms whose time is recorded while profiling is on: the
+# separate factors of shannon and the combined ones the bitboard and
+# incremental evaluations use
+profiled_factors = ["checkmate_score", "material_score", "piece_bonuses", "postion_score",
+                    "mobility_bonus", "aggression_bonus", "open_rook_bishop_bonus",
+                    "double_pawn_penalty", "pin_penalty", "open_knight_penalty",
+                    "pin_candidates", "dynamic_terms", "attack_count", "shannon_sum"]
+
+# Calls and seconds spent in each factor since profiling was started. A
+# factor called by another one, like dynamic_terms by shannon_sum, counts
+# toward both.
+factor_times = {}
+
+# Factors as they were before profiling replaced them with timed versions
+original_factors = {}
+
+# Wraps factor so every call adds its time to factor_times[name]
+def timed_factor(name, factor):
+    def timed(*args):
+        start_time = time.time()
+        try:
+            return factor(*args)
+        finally:
+            record = factor_times[name]
+            record[0] += 1
+            record[1] += time.time() - start_time
+    return timed
+
+# Starts recording the time spent in every factor. Only covers this
+# process, not the workers of a parallel search.
+def start_profiling():
+    if original_factors:
+        return
+    for name in profiled_factors:
+        original_factors[name] = globals()[name]
+        factor_times[name] = [0, 0.0]
+        globals()[name] = timed_factor(name, original_factors[name])
+
+# Puts the untimed factors back, the recorded times are kept
+def stop_profiling():
+    globals().update(original_factors)
+    original_factors.clear()
+
+# Whether factor times are being recorded
+def profiling():
+    return bool(original_factors)
+
+# Calls, total seconds and microseconds per call of every profiled factor
+def factor_profile():
+    profile = {}
+    for name, (calls, seconds) in factor_times.items():
+        profile[name] = {"calls": calls, "seconds": seconds,
+                         "microseconds_per_call": 1e6*seconds/calls if calls else 0.0}
+    return profile
@@ -0,0 +1,234 @@
+# Michael Chen, 2016
+
+# Libraries
+import argparse
+import chess
+import chess.pgn
+import chess_algos
+import json
+import math
+import multiprocessing
+import os
+import sys
+
+# Openings the games start from when no suite is given, as moves from the
+# starting position. Every opening is played twice with the colors swapped.
+default_openings = [
+    "e2e4 e7e5 g1f3 b8c6 f1b5",
+    "e2e4 e7e5 g1f3 b8c6 f1c4",
+    "e2e4 c7c5 g1f3 d7d6",
+    "e2e4 c7c5 b1c3 b8c6",
+    "e2e4 e7e6 d2d4 d7d5",
+    "e2e4 c7c6 d2d4 d7d5",
+    "e2e4 d7d5 e4d5 d8d5",
+    "d2d4 d7d5 c2c4 e7e6",
+    "d2d4 d7d5 c2c4 c7c6",
+    "d2d4 g8f6 c2c4 e7e6",
+    "d2d4 g8f6 c2c4 g7g6",
+    "d2d4 f7f5 g2g3",
+    "c2c4 e7e5 b1c3",
+    "g1f3 d7d5 g2g3",
+    "e2e4 g7g6 d2d4 f8g7",
+    "d2d4 d7d5 g1f3 g8f6 e2e3"]
+
+# Piece values used to adjudicate games that are clearly decided
+adjudication_values = {chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9}
+
+# Reads an opening suite: one opening per line, either a FEN/EPD position
+# or moves in UCI notation from the starting position
+def read_openings(path):
+    openings = []
+    with open(path) as suite:
+        for line in suite:
+            line = line.split(";")[0].strip()
+            if line:
+                openings.append(line)
+    return openings
+
+# Board after an opening from the suite
+def opening_board(opening):
+    if "/" in opening:
+        fields = opening.split()
+        # EPD lines leave out the move counters
+        return chess.Board(" ".join(fields[:4] + ["0", "1"]))
+    board = chess.Board()
+    for move in opening.split():
+        board.push_uci(move)
+    return board
+
+# Creates an engine from a spec like "Negamax(4)" or "Minimax(3, True)"
+def build_engine(spec):
+    return eval(spec, {"__builtins__": {}},
+                {"Random": chess_algos.Random, "Minimax": chess_algos.Minimax, "Negamax": chess_algos.Negamax,
+                 "MCTS": chess_algos.MCTS, "True": True, "False": False, "None": None})
+
+# Material of white minus material of black, in pawns
+def material_balance(board):
+    balance = 0
+    for piece_type, value in adjudication_values.items():
+        balance += value*(len(board.pieces(piece_type, chess.WHITE)) - len(board.pieces(piece_type, chess.BLACK)))
+    return balance
+
+# Keeps the engines' own output out of the way of the match report
+def init_worker():
+    sys.stdout = open(os.devnull, "w")
+
+# Plays one game in a worker and returns its record. task holds the game
+# number, the opening, whether the first engine has white, both engine
+# specs and the adjudication settings.
+def play_game(task):
+    index, opening, first_white, specs, max_plies, material_margin, material_plies = task
+    board = opening_board(opening)
+    opening_length = len(board.move_stack)
+    engines = {chess.WHITE: build_engine(specs[0 if first_white else 1]),
+               chess.BLACK: build_engine(specs[1 if first_white else 0])}
+    # Plies in a row one side has been ahead by the material margin
+    ahead_plies = 0
+    while True:
+        if board.is_game_over(claim_draw=True):
+            result = board.result(claim_draw=True)
+            reason = "checkmate" if board.is_checkmate() else "draw"
+            break
+        if len(board.move_stack) - opening_length >= max_plies:
+            result, reason = "1/2-1/2", "adjudicated draw, move limit"
+            break
+        balance = material_balance(board)
+        ahead_plies = ahead_plies + 1 if abs(balance) >= material_margin else 0
+        if ahead_plies >= material_plies:
+            result, reason = ("1-0" if balance > 0 else "0-1"), "adjudicated win, material"
+            break
+        move = engines[board.turn].next_move(board)
+        if move is None or not board.is_legal(move):
+            result, reason = ("0-1" if board.turn else "1-0"), "illegal move"
+            break
+        board.push(move)
+
+    for engine in engines.values():
+        if isinstance(engine, (chess_algos.Negamax, chess_algos.MCTS)):
+            engine.close()
+    game = chess.pgn.Game.from_board(board)
+    game.headers["Event"] = "Self-play match"
+    game.headers["Round"] = str(index + 1)
+    game.headers["White"] = specs[0 if first_white else 1]
+    game.headers["Black"] = specs[1 if first_white else 0]
+    game.headers["Result"] = result
+    game.headers["Termination"] = reason
+    # Score of the first engine
+    if result == "1/2-1/2":
+        score = 0.5
+    else:
+        score = 1.0 if (result == "1-0") == first_white else 0.0
+    return {"game": index, "opening": opening, "first_white": first_white, "result": result,
+            "reason": reason, "plies": len(board.move_stack) - opening_length, "score": score,
+            "pgn": str(game)}
+
+# Expected score of a player that is elo points stronger
+def expected_score(elo):
+    return 1.0/(1.0 + 10**(-elo/400.0))
+
+# Log likelihood ratio of the first engine being elo1 rather than elo0
+# points stronger, given its wins, draws and losses. Uses the normal
+# approximation of the game scores.
+def sprt_llr(wins, draws, losses, elo0, elo1):
+    games = wins + draws + losses
+    if not wins + losses or not games:
+        return 0.0
+    score = (wins + 0.5*draws)/games
+    variance = (wins*(1 - score)**2 + draws*(0.5 - score)**2 + losses*score**2)/games
+    if variance == 0:
+        return 0.0
+    score0 = expected_score(elo0)
+    score1 = expected_score(elo1)
+    return games*(score1 - score0)*(2*score - score0 - score1)/(2*variance)
+
+# LLR bounds for the given false positive and false negative rates
+def sprt_bounds(alpha, beta):
+    return (math.log(beta/(1 - alpha)), math.log((1 - beta)/alpha))
+
+# Elo difference matching a score, None if it's 0 or 1
+def score_elo(score):
+    if score <= 0 or score >= 1:
+        return None
+    return -400*math.log10(1/score - 1)
+
+# Plays games between two engine specs in a process pool, appending each
+# game to the results and PGN files as soon as it finishes. Stops once the
+# SPRT accepts either hypothesis. Returns the wins, draws and losses of the
+# first engine and the SPRT outcome.
+def run_match(specs, games, workers, openings, results_path, pgn_path, max_plies=300,
+              material_margin=9, material_plies=8, elo0=0, elo1=10, alpha=0.05, beta=0.05):
+    tasks = ((index, openings[(index // 2) % len(openings)], index % 2 == 0, specs,
+              max_plies, material_margin, material_plies) for index in range(games))
+    lower, upper = sprt_bounds(alpha, beta)
+    wins = draws = losses = 0
+    outcome = None
+    pool = multiprocessing.Pool(workers, init_worker)
+    try:
+        with open(results_path, "a") as results_file, open(pgn_path, "a") as pgn_file:
+            for record in pool.imap_unordered(play_game, tasks):
+                pgn_file.write(record.pop("pgn") + "\n\n")
+                pgn_file.flush()
+                results_file.write(json.dumps(record) + "\n")
+                results_file.flush()
+                if record["score"] == 1:
+                    wins += 1
+                elif record["score"] == 0:
+                    losses += 1
+                else:
+                    draws += 1
+                llr = sprt_llr(wins, draws, losses, elo0, elo1)
+                print "Games: " + str(wins + draws + losses) + " +" + str(wins) + " =" + str(draws) + \
+                    " -" + str(losses) + " LLR: " + str(round(llr, 2)) + " (" + str(round(lower, 2)) + \
+                    ", " + str(round(upper, 2)) + ")"
+                sys.stdout.flush()
+                if llr >= upper:
+                    outcome = "H1"
+                    break
+                elif llr <= lower:
+                    outcome = "H0"
+                    break
+    finally:
+        pool.terminate()
+    return (wins, draws, losses, outcome)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "plays two engine configurations against each other")
+    parser.add_argument("engine1",
+        help = "engine under test, e.g. \"Negamax(4)\"")
+    parser.add_argument("engine2",
+        help = "engine it plays against, e.g. \"Minimax(3, True)\"")
+    parser.add_argument("--games", type=int, default=1000,
+        help = "most games to play")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+        help = "number of games played at the same time")
+    parser.add_argument("--openings",
+        help = "file with one FEN/EPD or UCI move list per line to start games from")
+    parser.add_argument("--results", default="match_results.jsonl",
+        help = "file each game's result is appended to")
+    parser.add_argument("--pgn", default="match_games.pgn",
+        help = "file each game is appended to")
+    parser.add_argument("--max_plies", type=int, default=300,
+        help = "plies after the opening before a game is adjudicated a draw")
+    parser.add_argument("--material_margin", type=int, default=9,
+        help = "material lead in pawns that adjudicates a win")
+    parser.add_argument("--material_plies", type=int, default=8,
+        help = "plies in a row the lead has to last")
+    parser.add_argument("--elo0", type=float, default=0,
+        help = "elo difference of the SPRT null hypothesis")
+    parser.add_argument("--elo1", type=float, default=10,
+        help = "elo difference of the SPRT alternative hypothesis")
+    parser.add_argument("--alpha", type=float, default=0.05,
+        help = "SPRT false positive rate")
+    parser.add_argument("--beta", type=float, default=0.05,
+        help = "SPRT false negative rate")
+    args = parser.parse_args()
+
+    openings = read_openings(args.openings) if args.openings else default_openings
+    wins, draws, losses, outcome = run_match(
+        (args.engine1, args.engine2), args.games, args.workers, openings, args.results, args.pgn,
+        args.max_plies, args.material_margin, args.material_plies, args.elo0, args.elo1, args.alpha, args.beta)
+    games = wins + draws + losses
+    elo = score_elo((wins + 0.5*draws)/games) if games else None
+    print "Result: +" + str(wins) + " =" + str(draws) + " -" + str(losses) + \
+        " Elo: " + (str(round(elo, 1)) if elo is not None else "n/a") + \
+        " SPRT: " + {"H1": "engine1 is stronger", "H0": "engine1 is not stronger", None: "inconclusive"}[outcome]
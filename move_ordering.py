@@ -0,0 +1,163 @@
+# Michael Chen, 2016
+
+# Libraries
+import chess
+
+# Piece values used when trading off captures, the king is worth more than
+# anything it could win
+see_value_dict = {1: 100, 2: 320, 3: 330, 4: 500, 5: 900, 6: 20000}
+
+# Returns the square of the lowest set bit of a bitboard
+def lowest_square(mask):
+    return (mask & -mask).bit_length() - 1
+
+# Type of the piece a move captures, counting en passant as a pawn capture
+def captured_type(board, move):
+    if board.is_en_passant(move):
+        return chess.PAWN
+    return board.piece_type_at(move.to_square)
+
+# Most valuable victim first, then least valuable attacker
+def mvv_lva(board, move):
+    return 10*captured_type(board, move) - board.piece_type_at(move.from_square)
+
+# Value the side to move can win by capturing on square with its least
+# valuable attacker first and continuing the exchange for as long as it pays.
+# Pins are ignored.
+def see_exchange(board, square):
+    attackers = board.attackers_mask(board.turn, square)
+    if not attackers:
+        return 0
+    for piece_type in range(1, 7):
+        piece_attackers = attackers & board.pieces_mask(piece_type, board.turn)
+        if piece_attackers:
+            break
+    from_square = lowest_square(piece_attackers)
+    promotion = None
+    if piece_type == chess.PAWN and chess.rank_index(square) in (0, 7):
+        promotion = chess.QUEEN
+    captured_value = see_value_dict[board.piece_type_at(square)]
+    board.push(chess.Move(from_square, square, promotion))
+    value = max(0, captured_value - see_exchange(board, square))
+    board.pop()
+    return value
+
+# Static exchange evaluation of a capture: material won or lost once all
+# recaptures on the target square are played out
+def see(board, move):
+    value = see_value_dict[captured_type(board, move)]
+    if move.promotion:
+        value += see_value_dict[move.promotion] - see_value_dict[chess.PAWN]
+    board.push(move)
+    value -= see_exchange(board, move.to_square)
+    board.pop()
+    return value
+
+# Legal captures of the board, most valuable victim first
+def capture_moves(board):
+    turn = board.turn
+    captures = list(board.generate_legal_moves(chess.BB_ALL, board.occupied_co[not turn]))
+    if board.ep_square:
+        captures += [move for move in board.generate_legal_moves(
+                        board.pawns & board.occupied_co[turn], chess.BB_SQUARES[board.ep_square])
+                     if board.is_en_passant(move)]
+    captures.sort(key=lambda move: mvv_lva(board, move), reverse=True)
+    return captures
+
+# Legal captures and then promotions without a capture
+def tactical_moves(board):
+    turn = board.turn
+    promotion_rank = chess.BB_RANKS[7] if turn else chess.BB_RANKS[0]
+    return capture_moves(board) + list(board.generate_legal_moves(
+        board.pawns & board.occupied_co[turn], promotion_rank & ~board.occupied))
+
+# Keeps the killer moves and history table used to order quiet moves, and
+# hands out the moves of a node in stages
+class MoveOrdering:
+
+    """Deepest ply that killer moves are kept for"""
+    max_ply = 64
+
+    # Start with empty tables
+    def __init__(self):
+        self.clear()
+
+    # Forget all killer moves and history
+    def clear(self):
+        # Two quiet moves per ply that recently caused a cutoff
+        self.killers = [[None, None] for ply in range(self.max_ply)]
+        # Cutoff counts indexed by color, from square and to square
+        self.history = [0]*(2*64*64)
+
+    # Called before a new search, older history counts less
+    def new_search(self):
+        self.killers = [[None, None] for ply in range(self.max_ply)]
+        self.history = [count // 2 for count in self.history]
+
+    # Index of a move in the history table
+    def history_index(self, color, move):
+        return (4096 if color else 0) + move.from_square*64 + move.to_square
+
+    # Records a move that caused a beta cutoff at a node with the given
+    # remaining depth. Only quiet moves are recorded.
+    def update(self, board, move, depth, ply):
+        if board.is_capture(move) or move.promotion:
+            return
+        if ply < self.max_ply and self.killers[ply][0] != move:
+            self.killers[ply][1] = self.killers[ply][0]
+            self.killers[ply][0] = move
+        self.history[self.history_index(board.turn, move)] += depth*depth
+
+    # Yields the legal moves of the board in stages: the hash move, winning
+    # or even captures by MVV-LVA, killer moves, quiet moves by history and
+    # finally losing captures. A stage is only generated once the moves of
+    # the stages before it failed to cut off.
+    def pick_moves(self, board, hash_move=None, ply=0):
+        if hash_move is not None and board.is_legal(hash_move):
+            yield hash_move
+        else:
+            hash_move = None
+
+        turn = board.turn
+        enemy = board.occupied_co[not turn]
+        captures = [move for move in capture_moves(board) if move != hash_move]
+        # Only captures by a piece worth more than its victim can lose material
+        bad_captures = []
+        for move in captures:
+            if (see_value_dict[board.piece_type_at(move.from_square)] > see_value_dict[captured_type(board, move)]
+                    and see(board, move) < 0):
+                bad_captures.append(move)
+            else:
+                yield move
+
+        killers = []
+        if ply < self.max_ply:
+            for killer in self.killers[ply]:
+                if (killer is not None and killer != hash_move
+                        and not board.is_capture(killer) and board.is_legal(killer)):
+                    killers.append(killer)
+                    yield killer
+
+        # Everything but enemy squares, since castling may be generated as
+        # the king moving onto its own rook
+        not_enemy = ~enemy & chess.BB_ALL
+        quiets = list(board.generate_legal_moves(chess.BB_ALL, not_enemy))
+        # Leave out the moves already tried and en passant, which lands on an
+        # empty square. Moves compare in Python code, so each filter is only
+        # run when there is something to leave out.
+        tried = killers + [hash_move] if hash_move is not None else killers
+        if tried:
+            quiets = [move for move in quiets if move not in tried]
+        if board.ep_square:
+            quiets = [move for move in quiets if not board.is_en_passant(move)]
+        history = self.history
+        offset = 4096 if turn else 0
+        # Promotions go first, the rest by how often they cut off before. The
+        # key is a single int, a tuple would be built and compared per move.
+        quiets.sort(key=lambda move: ((move.promotion or 0) << 48) + history[offset + move.from_square*64 + move.to_square],
+                    reverse=True)
+        for move in quiets:
+            yield move
+
+        for move in bad_captures:
+            yield move
@@ -0,0 +1,116 @@
+# Michael Chen, 2016
+
+# Libraries
+import Queue
+import chess_algos
+import threading
+
+# Search of one position running in a background thread, so the caller is
+# free while the engine thinks. Every completed iteration is put on a queue
+# as it finishes, and the search can be stopped at any point. Created by
+# start().
+class SearchHandle:
+
+    # Sets the engine up for limits and starts searching a copy of board.
+    # callback, if given, is called from the search thread with every update.
+    def __init__(self, engine, board, limits, callback=None):
+        self.engine = engine
+        self.callback = callback
+        # Iteration updates not read yet, None marks the end of the search
+        self.updates_queue = Queue.Queue()
+        # Last update, the move found once the search is over and the
+        # exception it raised, if any
+        self.latest = None
+        self.move = None
+        self.error = None
+        time_left = None
+        increment = 0
+        if "depth" in limits:
+            engine.depth = limits["depth"]
+        if isinstance(engine, chess_algos.Negamax):
+            if "time" in limits:
+                engine.timeout = engine.soft_timeout = limits["time"]
+            time_left = limits.get("time_left")
+            increment = limits.get("increment", 0)
+        engine.stop_flag.value = 0
+        # The engine's own callback, like the UCI info lines, keeps working
+        self.engine_callback = engine.stats.callback
+        engine.stats.callback = self.iteration_done
+        self.thread = threading.Thread(target=self.run, args=(board.copy(), time_left, increment))
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Body of the search thread
+    def run(self, board, time_left, increment):
+        try:
+            if isinstance(self.engine, chess_algos.Negamax):
+                self.move = self.engine.next_move(board, time_left, increment)
+            else:
+                self.move = self.engine.next_move(board)
+        except Exception as error:
+            self.error = error
+        finally:
+            self.engine.stats.callback = self.engine_callback
+            self.updates_queue.put(None)
+
+    # Called by the engine after every completed iteration
+    def iteration_done(self, stats):
+        iteration = stats.iterations[-1]
+        nodes = iteration["nodes"] + iteration["qnodes"]
+        seconds = iteration["seconds"]
+        update = {"depth": iteration["depth"], "score": iteration["score"], "pv": iteration["pv"],
+                  "nodes": nodes, "nps": nodes/seconds if seconds > 0 else 0.0, "seconds": seconds}
+        self.latest = update
+        self.updates_queue.put(update)
+        if self.callback:
+            self.callback(update)
+        if self.engine_callback:
+            self.engine_callback(stats)
+
+    # Yields the iteration updates as they come in, each a dictionary with
+    # the depth, score, pv (UCI moves), nodes, nps and seconds since the
+    # start, until the search is over. Only one reader should take them.
+    def updates(self):
+        while True:
+            # A timeout keeps the wait interruptible by Ctrl-C
+            try:
+                update = self.updates_queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if update is None:
+                self.updates_queue.put(None)
+                return
+            yield update
+
+    # Whether the search thread is still going
+    def running(self):
+        return self.thread.is_alive()
+
+    # Waits up to timeout seconds, forever if None, for the search to end.
+    # Returns its move, or None if it's still going, and raises whatever
+    # the search raised.
+    def wait(self, timeout=None):
+        # join without a timeout can't be interrupted in Python 2
+        while self.thread.is_alive() and timeout is None:
+            self.thread.join(0.1)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            return None
+        if self.error:
+            raise self.error
+        return self.move
+
+    # Stops the search and returns the move of its deepest completed
+    # iteration. Negamax stops within a few dozen nodes. A Minimax search
+    # has no iterations to fall back on and returns the best root move it
+    # finished searching, the naive one can't be stopped and runs to its end.
+    def stop(self):
+        self.engine.stop()
+        return self.wait()
+
+# Starts searching board with engine, a Minimax or Negamax, and returns the
+# handle of the search. limits may hold the depth, the fixed time in
+# seconds and the time_left and increment of a clock, the last three only
+# for Negamax; anything left out keeps the engine's own setting.
+def start(engine, board, limits=None, callback=None):
+    return SearchHandle(engine, board, limits or {}, callback)
@@ -0,0 +1,90 @@
+# Michael Chen, 2016
+
+# Libraries
+import evaluation
+
+# Counters and per-iteration results of the last search of an engine. The
+# engines reset their stats at the start of every move and add an iteration
+# after each completed depth, then call callback with the stats, if given.
+# With worker processes the node counts include the workers, the table and
+# cutoff counts only cover the main process.
+class SearchStats:
+
+    """Longest move list a cutoff index is recorded for"""
+    max_moves = 256
+
+    # Start out empty, callback is called after every iteration
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.reset()
+
+    # Forget the last search
+    def reset(self):
+        # Totals over all completed iterations
+        self.nodes = 0
+        self.qnodes = 0
+        self.tt_probes = 0
+        self.tt_hits = 0
+        self.eval_probes = 0
+        self.eval_hits = 0
+        # Beta cutoffs by the index of the move that caused them
+        self.cutoffs = [0]*self.max_moves
+        # One dictionary per completed iteration
+        self.iterations = []
+
+    # Records a beta cutoff by the move at index in the move order
+    def cutoff(self, index):
+        if index < self.max_moves:
+            self.cutoffs[index] += 1
+
+    # Records a completed iteration. nodes, qnodes and seconds are totals
+    # since the search started, tt and eval_cache are the tables the search
+    # probed (eval_cache may be None).
+    def add_iteration(self, depth, score, pv, nodes, qnodes, tt, eval_cache, seconds):
+        iteration_nodes = nodes + qnodes - self.nodes - self.qnodes
+        # Effective branching factor: how many times more nodes this
+        # iteration took than the one before it
+        ebf = None
+        if self.iterations and self.iterations[-1]["iteration_nodes"]:
+            ebf = float(iteration_nodes)/self.iterations[-1]["iteration_nodes"]
+        self.nodes = nodes
+        self.qnodes = qnodes
+        self.tt_probes = tt.probes
+        self.tt_hits = tt.hits
+        if eval_cache:
+            self.eval_probes = eval_cache.probes
+            self.eval_hits = eval_cache.hits
+        self.iterations.append({"depth": depth, "score": score, "pv": [move.uci() for move in pv],
+                                "nodes": nodes, "qnodes": qnodes, "iteration_nodes": iteration_nodes,
+                                "ebf": ebf, "seconds": seconds})
+        if self.callback:
+            self.callback(self)
+
+    # Share of the probes that found their position in the table
+    def tt_hit_rate(self):
+        return float(self.tt_hits)/self.tt_probes if self.tt_probes else 0.0
+
+    # Share of the evaluations answered from the evaluation cache
+    def eval_hit_rate(self):
+        return float(self.eval_hits)/self.eval_probes if self.eval_probes else 0.0
+
+    # Share of the cutoffs caused by the first move searched, a measure of
+    # how good the move ordering is
+    def first_move_cutoff_rate(self):
+        total = sum(self.cutoffs)
+        return float(self.cutoffs[0])/total if total else 0.0
+
+    # Everything as plain data, ready for JSON. Factor timings are included
+    # while evaluation profiling is on.
+    def as_dict(self):
+        last_used = max([index for index, count in enumerate(self.cutoffs) if count] or [-1])
+        stats = {"nodes": self.nodes, "qnodes": self.qnodes,
+                 "tt_probes": self.tt_probes, "tt_hits": self.tt_hits, "tt_hit_rate": self.tt_hit_rate(),
+                 "eval_probes": self.eval_probes, "eval_hits": self.eval_hits,
+                 "eval_hit_rate": self.eval_hit_rate(),
+                 "cutoffs": self.cutoffs[:last_used + 1],
+                 "first_move_cutoff_rate": self.first_move_cutoff_rate(),
+                 "iterations": self.iterations}
+        if evaluation.profiling():
+            stats["factors"] = evaluation.factor_profile()
+        return stats
@@ -0,0 +1,357 @@
+# Michael Chen, 2016
+
+# Libraries
+import argparse
+import asynchat
+import asyncore
+import chess
+import chess_algos
+import collections
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+# Deepest iteration a search may reach when it is only limited by time
+max_depth = 64
+
+# Seconds a search gets when the request doesn't say
+default_time = 1.0
+
+# Evaluation cache of every game in megabytes, kept small since a worker
+# holds the tables of many games
+eval_cache_size = 1
+
+# Runs one request in a worker process. searches holds a Negamax per game,
+# so every game keeps its own transposition and move ordering tables, least
+# recently used first. At most max_games are kept, the games dropped to
+# make room are listed in the response so the service forgets them too.
+def run_request(searches, request, hash_size, max_games):
+    game = request.get("game")
+    response = {"id": request.get("id"), "game": game}
+    if request.get("end"):
+        searches.pop(game, None)
+        response["ended"] = True
+        return response
+    try:
+        board = chess.Board(request.get("fen", chess.STARTING_FEN))
+        for move in request.get("moves", []):
+            board.push_uci(move)
+    except ValueError as error:
+        response["error"] = "bad position: " + str(error)
+        return response
+    search = searches.pop(game, None)
+    if search is None:
+        search = chess_algos.Negamax(max_depth, float("inf"), hash_size, eval_cache_size=eval_cache_size)
+        if len(searches) >= max_games:
+            response["evicted"] = [searches.popitem(last=False)[0]]
+    searches[game] = search
+    search.depth = min(int(request.get("depth", max_depth)), max_depth)
+    # A clock is budgeted like in a timed game, otherwise time is the most
+    # the move may take
+    time_left = request.get("time_left")
+    search.timeout = search.soft_timeout = float(request.get("time", default_time))
+    start_time = time.time()
+    search.stop_flag.value = 0
+    move = search.next_move(board, time_left, request.get("increment", 0))
+    response["move"] = move.uci() if move else None
+    if search.stats.iterations:
+        iteration = search.stats.iterations[-1]
+        response["score"] = iteration["score"]
+        response["depth"] = iteration["depth"]
+        response["pv"] = iteration["pv"]
+        response["nodes"] = iteration["nodes"] + iteration["qnodes"]
+    response["search_seconds"] = time.time() - start_time
+    return response
+
+# Main loop of a worker process: runs the requests it is sent over conn one
+# at a time and sends back each response, until it is sent None. A request
+# that fails is answered with the error, the worker carries on. inherited_fds
+# are the event loop's sockets and pipes the process got a copy of when it
+# was forked, closed so a client connection ends when the service closes it.
+def worker_main(conn, hash_size, max_games, inherited_fds):
+    for fd in inherited_fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    sys.stdout = open(os.devnull, "w")
+    searches = collections.OrderedDict()
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        try:
+            response = run_request(searches, request, hash_size, max_games)
+        except Exception as error:
+            searches.pop(request.get("game"), None)
+            response = {"id": request.get("id"), "game": request.get("game"), "error": repr(error)}
+        conn.send(response)
+
+# Value below which the given fraction of the sorted values fall
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction*len(sorted_values)))]
+
+# Event loop end of a worker process. Requests for the worker wait in queue
+# and are sent one at a time, when the worker is done with the one before,
+# so writing to the pipe never blocks. The loop watches the pipe and reads
+# the response once it's there. A worker process that dies is started again.
+class WorkerChannel(asyncore.dispatcher):
+
+    def __init__(self, service, hash_size, max_games, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.service = service
+        self.hash_size = hash_size
+        self.max_games = max_games
+        # (request, client, time received) waiting to be sent, and the one
+        # the worker is on
+        self.queue = collections.deque()
+        self.current = None
+        # Games whose searches live in this worker
+        self.games = set()
+        # Times the worker process died and was started again
+        self.restarts = 0
+        self.start_process()
+
+    # Starts the worker process and watches its end of the pipe
+    def start_process(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_main,
+            args=(child_conn, self.hash_size, self.max_games, list(self._map)))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self._fileno = self.conn.fileno()
+        self.add_channel()
+
+    # Queues a request and sends it right away if the worker is idle
+    def submit(self, request, client, received):
+        self.queue.append((request, client, received))
+        if self.current is None:
+            self.send_next()
+
+    def send_next(self):
+        if self.queue:
+            self.current = self.queue.popleft()
+            self.conn.send(self.current[0])
+
+    # Only ever read from, the pipe is written to directly
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    # The worker finished the current request
+    def handle_read(self):
+        try:
+            response = self.conn.recv()
+        except (EOFError, IOError):
+            self.restart()
+            return
+        request, client, received = self.current
+        self.current = None
+        self.send_next()
+        self.service.finish(self, request, client, received, response)
+
+    # There is no socket to close, only stop watching the pipe
+    def handle_close(self):
+        self.del_channel()
+
+    # The worker process died. Its request and the ones waiting for it are
+    # answered with an error, and a new process takes its place. The games
+    # stay with this worker, their tables are gone and start out empty.
+    def restart(self):
+        self.del_channel()
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.restarts += 1
+        failed = ([self.current] if self.current else []) + list(self.queue)
+        self.current = None
+        self.queue.clear()
+        self.start_process()
+        for request, client, received in failed:
+            self.service.finish(self, request, client, received,
+                                {"id": request.get("id"), "game": request.get("game"), "error": "worker died"})
+
+    # Tells the worker process to exit
+    def shutdown(self):
+        self.del_channel()
+        self.conn.send(None)
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+# One client connection. Requests and responses are JSON objects, one per
+# line. Searches are answered when they finish, so a client may have
+# several requests out at once and match the answers up by id.
+class ClientChannel(asynchat.async_chat):
+
+    def __init__(self, service, sock, socket_map):
+        asynchat.async_chat.__init__(self, sock, map=socket_map)
+        self.service = service
+        self.buffer = []
+        self.closed = False
+        self.set_terminator("\n")
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = "".join(self.buffer).strip()
+        self.buffer = []
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request is not an object")
+        except ValueError as error:
+            self.respond({"error": "bad request: " + str(error)})
+            return
+        self.service.handle_request(request, self)
+
+    def respond(self, response):
+        if not self.closed:
+            self.push(json.dumps(response, sort_keys=True) + "\n")
+
+    def handle_close(self):
+        self.closed = True
+        self.close()
+
+# Accepts client connections
+class ServerChannel(asyncore.dispatcher):
+
+    def __init__(self, service, host, port, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.service = service
+        self.socket_map = socket_map
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(64)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            ClientChannel(self.service, pair[0], self.socket_map)
+
+# Serves searches for many games at once from a single-threaded event loop.
+# Python 2 has no asyncio, so the loop is asyncore's, over the client
+# sockets and a pipe to every worker process. Each game is given to the
+# worker with the fewest games the first time it's seen and stays there,
+# so its tables stay warm from one move to the next. A request may be:
+#   {"id": 1, "game": "g1", "fen": ..., "moves": [...], "time": 1.0}
+#       search the position, "depth" caps the depth and "time_left" and
+#       "increment" budget the time from a clock instead of "time"
+#   {"game": "g1", "end": true}    drop the game's tables
+#   {"stats": true}                queue depth and latency percentiles
+class Service:
+
+    # Starts the worker processes and listens on host and port. Latencies
+    # are kept for the last latency_window requests.
+    def __init__(self, host="127.0.0.1", port=8765, workers=1, hash_size=2, max_games=32,
+                 latency_window=1000):
+        self.socket_map = {}
+        # Workers are started before the listening socket is opened, so
+        # they don't inherit it
+        self.workers = [WorkerChannel(self, hash_size, max_games, self.socket_map) for index in range(workers)]
+        self.games = {}
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.completed = 0
+        self.server = ServerChannel(self, host, port, self.socket_map)
+        self.address = self.server.socket.getsockname()
+
+    # Runs a request from a client, searches are handed to the game's worker
+    def handle_request(self, request, client):
+        if request.get("stats"):
+            client.respond(self.stats())
+            return
+        game = request.get("game")
+        if game is None:
+            client.respond({"id": request.get("id"), "error": "bad request: no game"})
+            return
+        worker = self.games.get(game)
+        if worker is None:
+            worker = min(self.workers, key=lambda worker: len(worker.games))
+            worker.games.add(game)
+            self.games[game] = worker
+        worker.submit(request, client, time.time())
+
+    # Called when a worker sends back a response
+    def finish(self, worker, request, client, received, response):
+        ended = response.pop("evicted", [])
+        if request.get("end"):
+            ended.append(request.get("game"))
+        for game in ended:
+            worker.games.discard(game)
+            # The game may have been given to another worker since
+            if self.games.get(game) is worker:
+                del self.games[game]
+        latency = time.time() - received
+        response["latency"] = latency
+        self.latencies.append(latency)
+        self.completed += 1
+        client.respond(response)
+
+    # Requests waiting for a worker, requests being searched and latency
+    # percentiles in seconds, from request received to response sent
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {"queue_depth": sum(len(worker.queue) for worker in self.workers),
+                "in_flight": sum(1 for worker in self.workers if worker.current is not None),
+                "completed": self.completed, "games": len(self.games),
+                "worker_restarts": sum(worker.restarts for worker in self.workers),
+                "latency": {"p50": percentile(latencies, 0.5), "p90": percentile(latencies, 0.9),
+                            "p99": percentile(latencies, 0.99), "max": latencies[-1] if latencies else None}}
+
+    # Runs the event loop, printing the stats every report_interval seconds
+    # while there is traffic, until interrupted
+    def serve(self, report_interval=10):
+        last_report = time.time()
+        last_completed = self.completed
+        try:
+            while True:
+                asyncore.loop(timeout=0.5, map=self.socket_map, count=1)
+                if report_interval and time.time() - last_report >= report_interval:
+                    if self.completed != last_completed:
+                        print json.dumps(self.stats(), sort_keys=True)
+                        sys.stdout.flush()
+                    last_report = time.time()
+                    last_completed = self.completed
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    # Stops the workers and closes every connection
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown()
+        asyncore.close_all(self.socket_map)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "serves negamax searches for many games at once over TCP")
+    parser.add_argument("--host", default="127.0.0.1",
+        help = "address to listen on")
+    parser.add_argument("--port", type=int, default=8765,
+        help = "port to listen on")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+        help = "number of search processes")
+    parser.add_argument("--hash_size", type=int, default=2,
+        help = "transposition table size of every game in megabytes")
+    parser.add_argument("--max_games", type=int, default=32,
+        help = "most games a worker keeps tables for before dropping the least recently used")
+    parser.add_argument("--report_interval", type=float, default=10,
+        help = "seconds between stats lines, 0 turns them off")
+    args = parser.parse_args()
+    service = Service(args.host, args.port, args.workers, args.hash_size, args.max_games)
+    print "Listening on " + args.host + ":" + str(service.address[1])
+    sys.stdout.flush()
+    service.serve(args.report_interval)
@@ -3,12 +3,15 @@
 # Libraries
 from evaluation import Evaluation
 import argparse
+import book
 import chess
 import chess_algos
 import subprocess as sp
 import random
 import sys
 import terminaltables
+import threading
+import time
 
 # Dictionary mapping from ascii letter to piece name
 piece_dict = {"P": "Pawn", "N": "Knight", "B": "Bishop",
@@ -38,8 +41,30 @@ parser.add_argument("--minimax", action="store_true",
     help="optional flag to allow usage of minimax; random moves are default")
 parser.add_argument("--negamax", action="store_true",
     help="optional flag to allow usage of negamax; random moves are default")
+parser.add_argument("--mcts", action="store_true",
+    help="optional flag to allow usage of monte carlo tree search; random moves are default")
+parser.add_argument("--playouts", type=int, default=2000,
+    help="playouts monte carlo tree search runs per move, within the timeout")
+parser.add_argument("--workers", type=int, default=1,
+    help="number of processes negamax splits its root moves over, or mcts grows trees in")
+parser.add_argument("--speedup", action="store_true",
+    help="optional flag to time negamax with one worker and with --workers before playing")
+parser.add_argument("--clock", type=float,
+    help="seconds on each side's clock for a timed game; negamax budgets its time from it")
+parser.add_argument("--increment", type=float, default=0,
+    help="seconds added to a side's clock after each of its moves")
+parser.add_argument("--ponder", action="store_true",
+    help="optional flag to let negamax think on the human's time about the reply it expects")
+parser.add_argument("--book",
+    help="Polyglot .bin opening book; the engines only search once out of book")
 args = parser.parse_args()
 
+# Seconds left on each side's clock when playing a timed game
+clocks = {chess.WHITE: args.clock, chess.BLACK: args.clock}
+
+# Opening book both engines play from, if given
+opening_book = book.OpeningBook(args.book) if args.book else None
+
 # Handles all the commandline output colors
 class bcolors:
     HEADER = '\033[95m'
@@ -99,6 +124,96 @@ def board2string(board):
     builder.append(" |" + str(index))
     return "".join(builder)
 
+# Search running on the human's time, if any: the engine, the reply it
+# expects, the thread it runs in and a list its move is put in
+ponder_search = None
+
+# Starts searching, in the background, the position after the reply the
+# engine expects from the human: the second move of the principal
+# variation of the search that found the engine's last move
+def start_pondering(algo, board):
+    global ponder_search
+    if not args.ponder or not isinstance(algo, chess_algos.Negamax) or not algo.stats.iterations:
+        return
+    pv = algo.stats.iterations[-1]["pv"]
+    # The last move may have come from the book instead of this search
+    if len(pv) < 2 or pv[0] != board.peek().uci():
+        return
+    expected = chess.Move.from_uci(pv[1])
+    if not board.is_legal(expected):
+        return
+    ponder_board = board.copy()
+    ponder_board.push(expected)
+    if ponder_board.is_game_over():
+        return
+    time_left = clocks[ponder_board.turn] if args.clock is not None else None
+    result = []
+    algo.stop_flag.value = 0
+    # Set here rather than by the search, the human's move may come before
+    # the thread gets going
+    algo.pondering = True
+    thread = threading.Thread(target=lambda: result.append(
+        algo.next_move(ponder_board, time_left, args.increment, True)))
+    thread.daemon = True
+    thread.start()
+    ponder_search = (algo, expected, thread, result)
+
+# Ends the search started on the human's time. If the human played the
+# expected move the search goes on with the normal time limits from now and
+# its move is returned. Otherwise it's thrown away and None is returned, the
+# transposition table and history it filled are kept for the next search.
+def finish_pondering(board):
+    global ponder_search
+    if ponder_search is None:
+        return None
+    algo, expected, thread, result = ponder_search
+    ponder_search = None
+    if board.move_stack and board.peek() == expected:
+        print "Ponder hit"
+        algo.ponderhit()
+        # Workers of a parallel search may still be on a root move that was
+        # started without a deadline
+        thread.join(algo.limits[1])
+        if thread.is_alive():
+            algo.stop()
+        thread.join()
+        algo.stop_flag.value = 0
+        return result[0]
+    print "Ponder miss"
+    algo.stop()
+    thread.join()
+    algo.stop_flag.value = 0
+    return None
+
+# Gets the AI's move, from the search that ran on the human's time if it
+# guessed the human's move, from the opening book while the position is in
+# it and otherwise by searching, giving negamax the time left on its clock
+def engine_move(algo, board):
+    move = finish_pondering(board)
+    if move is not None:
+        return move
+    if opening_book:
+        move = opening_book.next_move(board)
+        if move is not None:
+            print "Book move"
+            return move
+    if args.clock is not None and isinstance(algo, chess_algos.Negamax):
+        return algo.next_move(board, clocks[board.turn], args.increment)
+    return algo.next_move(board)
+
+# Charges a side for the time its move took and adds the increment.
+# Returns False if the side ran out of time.
+def charge_clock(color, move_time):
+    if args.clock is None:
+        return True
+    clocks[color] -= move_time
+    if clocks[color] < 0:
+        return False
+    clocks[color] += args.increment
+    print "Clock: White " + str(round(clocks[chess.WHITE], 1)) + "s, Black " + \
+        str(round(clocks[chess.BLACK], 1)) + "s"
+    return True
+
 # Wrapper to print the board with the Current Board header
 def print_board(board):
     print bcolors.HEADER + "Current Board:" + bcolors.ENDC
@@ -117,14 +232,26 @@ if __name__ == "__main__":
         algo_w = chess_algos.Minimax(args.white_moves_ahead, True)
         algo_b = chess_algos.Minimax(args.black_moves_ahead, True)
     elif args.negamax:
-        # initializes negamax with input moves ahead and timeout
-        algo_w = chess_algos.Negamax(args.white_moves_ahead, args.timeout_in_seconds)
-        algo_b = chess_algos.Negamax(args.black_moves_ahead, args.timeout_in_seconds)
+        # Report how much the extra workers help at white's depth
+        if args.speedup:
+            serial_time, parallel_time, speedup = chess_algos.parallel_speedup(
+                board, args.white_moves_ahead, args.workers)
+            print "1 worker: " + str(serial_time) + "s, " + str(args.workers) + " workers: " + \
+                str(parallel_time) + "s, speedup: " + str(speedup)
+        # initializes negamax with input moves ahead, timeout and workers
+        algo_w = chess_algos.Negamax(args.white_moves_ahead, args.timeout_in_seconds, workers=args.workers)
+        algo_b = chess_algos.Negamax(args.black_moves_ahead, args.timeout_in_seconds, workers=args.workers)
+    elif args.mcts:
+        # initializes mcts with the playout budget, timeout and workers
+        algo_w = chess_algos.MCTS(args.playouts, args.timeout_in_seconds, args.workers)
+        algo_b = chess_algos.MCTS(args.playouts, args.timeout_in_seconds, args.workers)
     else:
         # PARTY TIME RANDOM ALGO :-)
         algo_w = chess_algos.Random()
         algo_b = chess_algos.Random()
 
+    # Side that ran out of time, if any
+    flagged = None
     # Loops until game is over
     while not(board.is_game_over()):
         # Print the starting board
@@ -134,6 +261,7 @@ if __name__ == "__main__":
 
         while True:
             try:
+                move_start = time.time()
                 # Checks if human is playing white
                 if args.human_white:
                     # player moves
@@ -143,9 +271,14 @@ if __name__ == "__main__":
                     board.push_uci(next_move)
                 else:
                     # Otherwise execute the AI move for white
-                    next_move = algo_w.next_move(board)
+                    next_move = engine_move(algo_w, board)
                     print "Computer 1 makes: " + next_move.uci()
                     board.push_uci(next_move.uci())
+                    if args.human_black:
+                        start_pondering(algo_w, board)
+                if not charge_clock(chess.WHITE, time.time() - move_start):
+                    flagged = chess.WHITE
+                    break
 
                 # Print the board between moves
                 print_board(board)
@@ -154,6 +287,7 @@ if __name__ == "__main__":
                 if board.is_game_over():
                     break
 
+                move_start = time.time()
                 # Checks if human is playing black
                 if args.human_black:
                     # player moves
@@ -163,9 +297,13 @@ if __name__ == "__main__":
                     board.push_uci(next_move)
                 else:
                     # Execute AI move for black
-                    next_move = algo_b.next_move(board)
+                    next_move = engine_move(algo_b, board)
                     print "Computer 2 makes: " + next_move.uci()
                     board.push_uci(next_move.uci())
+                    if args.human_white:
+                        start_pondering(algo_b, board)
+                if not charge_clock(chess.BLACK, time.time() - move_start):
+                    flagged = chess.BLACK
 
                 break
             # Catch exceptions for bad inputs when playing in human move
@@ -173,6 +311,12 @@ if __name__ == "__main__":
                 print bcolors.FAIL + "Invalid input. Did you wrap your string in quotes?" + bcolors.ENDC
             except ValueError:
                 print bcolors.FAIL + "Invalid move. Please choose a move that is in the list of legal moves." + bcolors.ENDC
+        # Stop the game if a side lost on time
+        if flagged is not None:
+            break
     # Prints the end result of the game
-    print "Game Over: " + str(board.result())
+    if flagged is not None:
+        print "Game Over: " + ("0-1" if flagged == chess.WHITE else "1-0") + " on time"
+    else:
+        print "Game Over: " + str(board.result())
 
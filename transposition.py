@@ -0,0 +1,95 @@
+# Michael Chen, 2016
+
+# Libraries
+import chess
+import numpy
+
+# Bound flags stored alongside every score
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# Bytes taken by one entry: key, score, move, depth, flag and age
+ENTRY_SIZE = 8 + 8 + 2 + 1 + 1 + 1
+
+# Packs a move into 16 bits (from, to and promotion piece)
+def encode_move(move):
+    if move is None:
+        return 0
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+# Moves unpacked so far, indexed by their code. Moves are never changed once
+# made, so every decode of a code hands out the same object instead of
+# building a new one.
+decoded_moves = [None]*(1 << 15)
+
+# Unpacks a move packed by encode_move
+def decode_move(code):
+    move = decoded_moves[code]
+    if move is None and code:
+        promotion = code >> 12
+        move = decoded_moves[code] = chess.Move(code & 63, (code >> 6) & 63, promotion if promotion else None)
+    return move
+
+# Fixed-size transposition table keyed by the board's Zobrist hash.
+# python-chess keeps the piece placement part of board.zobrist_hash()
+# up to date on every push/pop, so computing the key at a node is cheap.
+class TranspositionTable:
+
+    # Initialize the table to fit into roughly size_mb megabytes
+    def __init__(self, size_mb=16):
+        self.size = max(1, int(size_mb * 1024 * 1024) // ENTRY_SIZE)
+        self.keys = numpy.zeros(self.size, dtype=numpy.uint64)
+        self.scores = numpy.zeros(self.size, dtype=numpy.float64)
+        self.moves = numpy.zeros(self.size, dtype=numpy.uint16)
+        self.depths = numpy.zeros(self.size, dtype=numpy.int8)
+        self.flags = numpy.zeros(self.size, dtype=numpy.uint8)
+        self.ages = numpy.zeros(self.size, dtype=numpy.uint8)
+        self.generation = 0
+        # Probes and probes that found their key since the last new_search
+        self.probes = 0
+        self.hits = 0
+        self.clear()
+
+    # Empty every slot
+    def clear(self):
+        self.depths.fill(-1)
+        self.moves.fill(0)
+        self.generation = 0
+
+    # Mark the start of a new search so older entries get replaced first
+    def new_search(self):
+        self.generation = (self.generation + 1) % 256
+        self.probes = 0
+        self.hits = 0
+
+    # Returns (depth, score, flag, move) for the key, or None on a miss
+    # Fields are read with item(), indexing would build a numpy scalar for
+    # each.
+    def probe(self, key):
+        index = key % self.size
+        self.probes += 1
+        depth = self.depths.item(index)
+        if depth < 0 or self.keys.item(index) != key:
+            return None
+        self.hits += 1
+        return (depth, self.scores.item(index), self.flags.item(index),
+                decode_move(self.moves.item(index)))
+
+    # Stores a search result. Slots from older searches are always replaced,
+    # otherwise the deeper result is kept.
+    def store(self, key, depth, score, flag, move):
+        index = key % self.size
+        stored_depth = self.depths.item(index)
+        same_key = stored_depth >= 0 and self.keys.item(index) == key
+        if (stored_depth >= 0 and not same_key
+                and self.ages.item(index) == self.generation and depth < stored_depth):
+            return
+        # Keep the old best move if this result didn't produce one
+        if move is not None or not same_key:
+            self.moves[index] = encode_move(move)
+        self.keys[index] = key
+        self.scores[index] = score
+        self.depths[index] = depth
+        self.flags[index] = flag
+        self.ages[index] = self.generation
@@ -0,0 +1,184 @@
+# Michael Chen, 2016
+
+# Libraries
+import chess
+import chess_algos
+import multiprocessing
+import sys
+import threading
+
+# Deepest iteration a search may reach when it is only limited by time
+max_depth = 64
+
+# Options the engine reports to the GUI: name, type, default, min and max
+options = [("Hash", "spin", 16, 1, 1024),
+           ("Threads", "spin", 1, 1, multiprocessing.cpu_count()),
+           ("Algorithm", "combo", "Negamax", ["Negamax", "Minimax"])]
+
+# Long-lived UCI engine process. The search runs in its own thread so
+# commands like stop and isready are still answered while it thinks, and
+# the same search object, with its transposition table and move ordering
+# tables, is kept from one move to the next.
+class UCIEngine:
+
+    # output is where UCI messages go. Anything the searches print goes to
+    # stderr instead, so it doesn't confuse the GUI.
+    def __init__(self, output):
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.hash_size = 16
+        self.threads = 1
+        self.algorithm = "Negamax"
+        self.search = None
+        self.search_thread = None
+        self.board = chess.Board()
+        self.build_search()
+
+    # Writes one line to the GUI
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    # Creates the search with the current options
+    def build_search(self):
+        if isinstance(self.search, chess_algos.Negamax):
+            self.search.close()
+        if self.algorithm == "Minimax":
+            self.search = chess_algos.Minimax(3, True, self.hash_size)
+        else:
+            self.search = chess_algos.Negamax(max_depth, float("inf"), self.hash_size, workers=self.threads)
+            self.search.stats.callback = self.send_info
+
+    # Reports the last completed iteration of the search
+    def send_info(self, stats):
+        iteration = stats.iterations[-1]
+        nodes = iteration["nodes"] + iteration["qnodes"]
+        seconds = iteration["seconds"]
+        nps = int(nodes/seconds) if seconds > 0 else 0
+        self.send("info depth " + str(iteration["depth"]) + " score cp " + str(int(round(iteration["score"]))) +
+                  " nodes " + str(nodes) + " nps " + str(nps) + " time " + str(int(1000*seconds)) +
+                  " pv " + " ".join(iteration["pv"]))
+
+    # Handles one line from the GUI, returns False on quit
+    def handle(self, line):
+        tokens = line.split()
+        if not tokens:
+            return True
+        command = tokens[0]
+        if command == "uci":
+            self.send("id name chess_ai")
+            self.send("id author Michael Chen")
+            for option in options:
+                if option[1] == "spin":
+                    self.send("option name %s type spin default %d min %d max %d" % ((option[0],) + option[2:]))
+                else:
+                    self.send("option name " + option[0] + " type combo default " + option[2] +
+                              "".join(" var " + value for value in option[3]))
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "setoption":
+            self.wait()
+            self.set_option(tokens)
+        elif command == "ucinewgame":
+            self.wait()
+            self.search.new_game()
+        elif command == "position":
+            self.wait()
+            self.set_position(tokens)
+        elif command == "go":
+            self.wait()
+            self.go(tokens)
+        elif command == "stop":
+            self.stop()
+        elif command == "quit":
+            self.stop()
+            if isinstance(self.search, chess_algos.Negamax):
+                self.search.close()
+            return False
+        return True
+
+    # setoption name <name> value <value>
+    def set_option(self, tokens):
+        if "name" not in tokens or "value" not in tokens:
+            return
+        name = " ".join(tokens[tokens.index("name") + 1:tokens.index("value")]).lower()
+        value = " ".join(tokens[tokens.index("value") + 1:])
+        if name == "hash":
+            self.hash_size = int(value)
+        elif name == "threads":
+            self.threads = int(value)
+        elif name == "algorithm" and value in options[2][3]:
+            self.algorithm = value
+        else:
+            return
+        self.build_search()
+
+    # position [startpos | fen <fen>] [moves <move> ...]
+    def set_position(self, tokens):
+        if "moves" in tokens:
+            moves = tokens[tokens.index("moves") + 1:]
+            tokens = tokens[:tokens.index("moves")]
+        else:
+            moves = []
+        if len(tokens) > 1 and tokens[1] == "fen":
+            self.board = chess.Board(" ".join(tokens[2:]))
+        else:
+            self.board = chess.Board()
+        for move in moves:
+            self.board.push_uci(move)
+
+    # go [depth <plies>] [movetime <ms>] [wtime <ms>] [btime <ms>]
+    #    [winc <ms>] [binc <ms>] [infinite]
+    # Starts the search in the background, bestmove is sent when it's done
+    def go(self, tokens):
+        limits = {}
+        for index, token in enumerate(tokens[:-1]):
+            if token in ("depth", "movetime", "wtime", "btime", "winc", "binc"):
+                limits[token] = int(tokens[index + 1])
+        self.search_thread = threading.Thread(target=self.think, args=(self.board.copy(), limits))
+        self.search_thread.daemon = True
+        self.search.stop_flag.value = 0
+        self.search_thread.start()
+
+    # Runs a search within the limits of a go command and sends the move
+    def think(self, board, limits):
+        search = self.search
+        if isinstance(search, chess_algos.Minimax):
+            # Minimax has no clock, it always searches to its depth
+            if "depth" in limits:
+                search.depth = limits["depth"]
+            move = search.next_move(board)
+        else:
+            search.depth = min(limits.get("depth", max_depth), max_depth)
+            search.timeout = search.soft_timeout = float("inf")
+            time_left = None
+            increment = 0
+            if "movetime" in limits:
+                search.timeout = search.soft_timeout = limits["movetime"]/1000.0
+            elif ("wtime" if board.turn else "btime") in limits:
+                time_left = limits["wtime" if board.turn else "btime"]/1000.0
+                increment = limits.get("winc" if board.turn else "binc", 0)/1000.0
+            move = search.next_move(board, time_left, increment)
+        self.send("bestmove " + (move.uci() if move else "0000"))
+
+    # Stops a running search and waits for its bestmove
+    def stop(self):
+        if self.search_thread:
+            self.search.stop()
+        self.wait()
+
+    # Waits for the running search, if any, to finish
+    def wait(self):
+        if self.search_thread:
+            self.search_thread.join()
+            self.search_thread = None
+
+if __name__ == "__main__":
+    output = sys.stdout
+    sys.stdout = sys.stderr
+    engine = UCIEngine(output)
+    for line in iter(sys.stdin.readline, ""):
+        if not engine.handle(line):
+            break